@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# -*- coding: latin-1 -*-
+"""Benchmarks of the pycefsnap hot paths.
+
+    python benchmark.py resource [--size <MB>] [--chunk <KB>] [--read <KB>] [--repeat <n>]
+    python benchmark.py pages [--pages <page,...>] [--modes <mode,...>] [--jobs <n>]
+                              [--concurrency <browsers>] [--cache]
+
+resource: feed a response body through WebRequestClient and read it back
+with ResourceHandler.ReadResponse like CEF does, and compare with the
+previous string concatenation buffering.
+
+pages: snapshot fixture pages served from a local HTTP server by running
+pycefsnap.py like in production, and report jobs/s, p50/p95/p99 latency,
+peak RSS and bytes through ResourceHandler from the .finished metadata.
+Pages: tiny, tall (30000px, size page), many (hundreds of subresources),
+drip (response body trickling in over 2s), object (Flash-like <object> and
+<embed> tags). Modes: single (one process per job, CEF initialized for each
+like a single command) and batch (all the jobs of a page in one process
+with --concurrency browsers). --cache gives the batches a resource cache.
+"""
+
+import io
+import os
+import sys
+import json
+import math
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+from time import time, sleep
+from PIL import Image
+
+import pycefsnap
+
+
+class FakeBrowser:
+
+    def __init__(self):
+        self._userData = {"metadata": {}}
+
+    def GetUserData(self, key):
+        return self._userData.get(key)
+
+    def SetUserData(self, key, value):
+        self._userData[key] = value
+
+
+class FakeRequest:
+
+    def GetUrl(self):
+        return "http://localhost/resource"
+
+
+class FakeResponse:
+
+    def GetStatus(self):
+        return 200
+
+    def GetMimeType(self):
+        return "application/octet-stream"
+
+    def GetStatusText(self):
+        return "OK"
+
+
+class FakeWebRequest:
+
+    def GetRequestStatus(self):
+        return 1
+
+    def GetRequestError(self):
+        return 0
+
+    def GetRequest(self):
+        return FakeRequest()
+
+    def GetResponse(self):
+        return FakeResponse()
+
+
+class FakeCallback:
+
+    def Continue(self):
+        pass
+
+
+def read_all(resHandler, read_size):
+    dataOut = [None]
+    bytesReadOut = [0]
+    total = 0
+    while resHandler.ReadResponse(dataOut, read_size, bytesReadOut, None):
+        total += bytesReadOut[0]
+    return total
+
+
+def resource_chunked(chunks, read_size):
+    browser = FakeBrowser()
+    clientHandler = pycefsnap.ClientHandler(browser, {})
+    resHandler = pycefsnap.ResourceHandler()
+    resHandler._clientHandler = clientHandler
+    resHandler._browser = browser
+    resHandler._responseHeadersReadyCallback = FakeCallback()
+    clientHandler._AddStrongReference(resHandler)
+    webRequestClient = pycefsnap.WebRequestClient()
+    webRequestClient._resourceHandler = resHandler
+    resHandler._webRequestClient = webRequestClient
+    webRequest = FakeWebRequest()
+    for chunk in chunks:
+        webRequestClient.OnDownloadData(webRequest, chunk)
+    webRequestClient.OnRequestComplete(webRequest)
+    return read_all(resHandler, read_size)
+
+
+class ConcatenatingClient:
+    _data = ""
+
+
+def resource_concatenated(chunks, read_size):
+    # The buffering pycefsnap used before: concatenation to an attribute,
+    # which CPython can't do in place, and slicing of the whole body
+    client = ConcatenatingClient()
+    for chunk in chunks:
+        client._data += chunk
+    data = client._data
+    offset = 0
+    total = 0
+    while offset < len(data):
+        dataChunk = data[offset:(offset + read_size)]
+        offset += len(dataChunk)
+        total += len(dataChunk)
+    return total
+
+
+def bench_resource(args):
+    chunk = "x" * (args.chunk * 1024)
+    chunks = [chunk] * (args.size * 1024 // args.chunk)
+    size = len(chunk) * len(chunks)
+    for name, func in (("chunked", resource_chunked), ("concatenated", resource_concatenated)):
+        best = None
+        for i in range(args.repeat):
+            start = time()
+            assert func(chunks, args.read * 1024) == size
+            elapsed = time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print "%-14s %6d MB in %7.3fs  %8.1f MB/s" % (name, args.size, best, args.size / best)
+
+
+def pixel_png():
+    buf = io.BytesIO()
+    Image.new("RGBA", (1, 1)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+FIXTURE_PAGES = {
+    'tiny': "<html><head><title>tiny</title></head><body><p>Hello</p></body></html>",
+    'tall': "<html><body style=\"margin: 0\"><div style=\"height: 30000px; background:"
+            " linear-gradient(#fff, #036)\">%s</div></body></html>"
+            % "".join("<p>Line %d</p>" % i for i in range(500)),
+    'many': "<html><head>%s%s</head><body>%s</body></html>" % (
+        "".join('<link rel="stylesheet" href="/asset/%d.css">' % i for i in range(20)),
+        "".join('<script src="/asset/%d.js"></script>' % i for i in range(20)),
+        "".join('<img src="/asset/%d.png" width="16" height="16">' % i for i in range(260))),
+    'drip': None,  # served by FixtureHandler._drip
+    'object': '<html><body><object type="application/x-shockwave-flash" data="/asset/movie.swf"'
+              ' width="400" height="300"><param name="movie" value="/asset/movie.swf">'
+              '<embed src="/asset/movie.swf" type="application/x-shockwave-flash" width="400"'
+              ' height="300"></object></body></html>',
+}
+
+ASSET_TYPES = {'.png': ("image/png", pixel_png()),
+               '.css': ("text/css", "p { color: #333 }\n" * 64),
+               '.js': ("application/javascript", "var x = 1;\n" * 256),
+               '.swf': ("application/x-shockwave-flash", "FWS" + "\x00" * 4093)}
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith("/asset/"):
+            mime_type, body = ASSET_TYPES.get(os.path.splitext(path)[1], ("text/plain", ""))
+            self._send(mime_type, body, "max-age=3600")
+        elif path == "/drip":
+            self._drip()
+        elif FIXTURE_PAGES.get(path[1:]):
+            self._send("text/html", FIXTURE_PAGES[path[1:]])
+        else:
+            self.send_error(404)
+
+    def _send(self, mime_type, body, cache_control="no-cache"):
+        self.send_response(200)
+        self.send_header("Content-Type", mime_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _drip(self):
+        # No Content-Length, the body trickles in 1KB every 100ms
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write("<html><body>")
+        for i in range(20):
+            self.wfile.write("<p>%s</p>" % ("x" * 1017))
+            self.wfile.flush()
+            sleep(0.1)
+        self.wfile.write("</body></html>")
+        self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_fixture_server():
+    server = FixtureServer(("127.0.0.1", 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def fixture_command(base_url, page, fpath):
+    command = {'url': base_url + "/" + page, 'file': fpath, 'delay': 1, 'flash_delay': 1,
+               'idle_time': 100, 'timeout': 30, 'html': 1, 'details': 2,
+               'screen_width': 1280, 'screen_height': 1024}
+    if page == "tall":
+        command['size'] = "page"
+    return command
+
+
+def percentile(values, p):
+    # Nearest rank
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def run_pages(mode, page, commands, workdir, args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pycefsnap.py")
+    with open(os.devnull, 'w') as devnull:
+        start = time()
+        if mode == "single":
+            for i, command in enumerate(commands):
+                fpath = os.path.join(workdir, "%s-%d.json" % (page, i))
+                with open(fpath, 'w') as f:
+                    json.dump(command, f)
+                subprocess.call([sys.executable, script, fpath], stdout=devnull, stderr=devnull)
+        else:
+            # An array is a batch even with one job, a single JSON line is not
+            fpath = os.path.join(workdir, "%s-batch.json" % page)
+            with open(fpath, 'w') as f:
+                json.dump(commands, f)
+            argv = [sys.executable, script, fpath, "--concurrency", str(args.concurrency)]
+            if args.cache:
+                argv += ["--cache", os.path.join(workdir, "cache")]
+            subprocess.call(argv, stdout=devnull, stderr=devnull)
+        elapsed = time() - start
+    results = []
+    for command in commands:
+        try:
+            with open(os.path.splitext(command['file'])[0] + ".finished") as f:
+                results.append(json.load(f))
+        except (IOError, ValueError):
+            results.append({'status': "error", 'error': "No metadata"})
+    return elapsed, results
+
+
+def bench_pages(args):
+    server = start_fixture_server()
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    workdir = tempfile.mkdtemp(prefix="pycefsnap-bench-")
+    print "%-7s %-7s %5s %6s %7s %7s %7s %7s %8s %9s" % (
+        "mode", "page", "jobs", "errors", "jobs/s", "p50", "p95", "p99", "peak MB", "MB read")
+    try:
+        for mode in args.modes.split(','):
+            for page in args.pages.split(','):
+                commands = [fixture_command(base_url, page, os.path.join(workdir, mode, "%s-%d.png" % (page, i)))
+                            for i in range(args.jobs)]
+                elapsed, results = run_pages(mode, page, commands, workdir, args)
+                latencies = [r['latency'] for r in results if 'latency' in r] or [0]
+                errors = sum(1 for r in results if r.get('error', "0") != "0")
+                print "%-7s %-7s %5d %6d %7.2f %7.3f %7.3f %7.3f %8.1f %9.2f" % (
+                    mode, page, len(results), errors, len(results) / elapsed,
+                    percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+                    max(r.get('peak_rss', 0) for r in results) / 1048576.0,
+                    sum(r.get('bytes_downloaded', 0) for r in results) / 1048576.0)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    resource = subparsers.add_parser('resource')
+    resource.add_argument('--size', type=int, default=16, help="response size in MB")
+    resource.add_argument('--chunk', type=int, default=16, help="download chunk size in KB")
+    resource.add_argument('--read', type=int, default=32, help="ReadResponse() size in KB")
+    resource.add_argument('--repeat', type=int, default=3)
+    resource.set_defaults(func=bench_resource)
+    pages = subparsers.add_parser('pages')
+    pages.add_argument('--pages', default=",".join(sorted(FIXTURE_PAGES)))
+    pages.add_argument('--modes', default="single,batch")
+    pages.add_argument('--jobs', type=int, default=10, help="jobs per page and mode")
+    pages.add_argument('--concurrency', type=int, default=4, help="browsers in flight in batch mode")
+    pages.add_argument('--cache', action='store_true', help="resource cache for the batches")
+    pages.set_defaults(func=bench_pages)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,15 +15,49 @@ else:
     # Import from package
     from cefpython3 import cefpython
 from PIL import Image
-from time import time
+from time import time, sleep, gmtime, strftime
 import traceback
 import json
+import fcntl
+import BaseHTTPServer
+import tempfile
+import re
+import fnmatch
+import urlparse
+import signal
+import hashlib
+import gzip
+import io
+import threading
+import Queue
+import itertools
+import argparse
 import multiprocessing.pool
 import lxml.html
+import lxml.etree
 import logging
 from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # --store-compression zstd only
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 
+MESSAGE_LOOP_INTERVAL = 0.005  # seconds between cefpython.MessageLoopWork() calls
+TILE_SETTLE_TIME = 0.05  # seconds to let the view repaint after scrolling to a tile
+# Resource types that blocking rules can name
+RESOURCE_TYPES = dict((name, getattr(cefpython, "RT_" + name.upper(), None)) for name in (
+    "main_frame", "sub_frame", "stylesheet", "script", "image", "font_resource", "sub_resource",
+    "object", "media", "worker", "shared_worker", "prefetch", "favicon", "xhr"))
+RESOURCE_TYPES['font'] = RESOURCE_TYPES['font_resource']
+PROXY_MAX_FAILURES = 3  # consecutive failures before a proxy is tried last
+PROXY_COOLDOWN = 300  # seconds before it is back in the rotation
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CACHE_SCAN_INTERVAL = 60  # seconds between rescans of the cache directory written by other workers
+MEMORY_SAMPLE_INTERVAL = 1.0  # seconds between RSS samples of the jobs in flight
+WATCHDOG_GRACE = 5  # seconds past the job timeout before a stuck snapshot process is killed
+
 
 def save_html(fpath, html):
     with open(fpath, 'w') as f:
@@ -35,11 +69,517 @@ def save_json(fpath, data):
         json.dump(data, f)
 
 
-def save_image(fpath, image, width, height):
-    image = Image.frombytes("RGBA", (width, height), image, "raw", "RGBA", 0, 1)
-    if os.path.exists(fpath):
-        os.remove(fpath)
-    image.save(fpath, "PNG")
+class OutputStore:
+    """Keeps the HTML and metadata of the jobs in a directory instead of
+    files next to the screenshots, shared by all workers.
+
+    HTML bodies are compressed and stored once per content hash under
+    html/, the metadata records are appended to one JSON Lines archive per
+    day (UTC) in place of the .finished files.
+    """
+
+    EXTENSIONS = {'gzip': ".gz", 'zstd': ".zst"}
+
+    def __init__(self, path, compression="gzip"):
+        if compression not in self.EXTENSIONS:
+            raise Exception("Unsupported compression: %s" % compression)
+        if compression == "zstd" and zstandard is None:
+            raise Exception("zstd compression needs the zstandard module")
+        self.path = path
+        self.compression = compression
+        if not os.path.exists(os.path.join(path, "html")):
+            os.makedirs(os.path.join(path, "html"))
+
+    def _compress(self, data):
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+
+    def save_html(self, html):
+        """Store |html| unless an identical body already is, return its
+        content hash and file path."""
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        digest = hashlib.sha1(html).hexdigest()
+        fpath = os.path.join(self.path, "html", digest[:2], digest + ".html" + self.EXTENSIONS[self.compression])
+        if os.path.exists(fpath):
+            return digest, fpath
+        try:
+            os.mkdir(os.path.dirname(fpath))
+        except OSError:
+            pass  # already there
+        tmp_fpath = "%s.%d.%d.tmp" % (fpath, os.getpid(), threading.current_thread().ident)
+        with open(tmp_fpath, 'wb') as f:
+            f.write(self._compress(html))
+        os.rename(tmp_fpath, fpath)
+        return digest, fpath
+
+    def append(self, record):
+        fpath = os.path.join(self.path, "metadata-%s.jsonl" % strftime("%Y%m%d", gmtime()))
+        line = json.dumps(record) + "\n"
+        with open(fpath, 'a') as f:
+            # Whole lines, whatever the number of writers
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+
+
+# Set by main() when --store is given
+output_store = None
+
+
+def as_image(image, width, height):
+    """Images are raw RGBA strings, or PIL images already for tiled captures."""
+    if isinstance(image, Image.Image):
+        return image
+    return Image.frombytes("RGBA", (width, height), image, "raw", "RGBA", 0, 1)
+
+
+def image_hashes(image):
+    """Exact (SHA-1 of the RGBA pixels) and perceptual (64 bit difference
+    hash) hashes of a screenshot, as hex strings."""
+    content = hashlib.sha1(image.tobytes()).hexdigest()
+    # Difference hash: is each pixel of a 9x8 grayscale reduction brighter
+    # than its right neighbour
+    pixels = list(image.convert("L").resize((9, 8), Image.ANTIALIAS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return content, "%016x" % bits
+
+
+def image_unchanged(command, metadata):
+    """Whether the screenshot matches the previous_hash, or is within
+    phash_distance bits of the previous_phash given in the command."""
+    if command.get('previous_hash') == metadata['image_hash']:
+        return True
+    if 'previous_phash' in command:
+        distance = bin(int(command['previous_phash'], 16) ^ int(metadata['image_phash'], 16)).count("1")
+        metadata['phash_distance'] = distance
+        return distance <= command.get('phash_distance', 0)
+    return False
+
+
+def make_thumbnails(image, sizes):
+    """Yield (width, height, thumbnail) for each size, largest first.
+
+    The screenshot is cropped from the top to the aspect ratio of the
+    thumbnail. A cheap nearest neighbour pass brings it down to twice the
+    thumbnail size before the antialiasing filter, and a thumbnail is made
+    from the previous one when it has the same aspect ratio.
+    """
+    previous = None
+    for width, height in sorted(sizes, key=lambda size: size[0] * size[1], reverse=True):
+        if previous and previous.size[0] * height == previous.size[1] * width:
+            source = previous
+        else:
+            crop_width = min(image.size[0], image.size[1] * width // height)
+            crop_height = min(image.size[1], image.size[0] * height // width)
+            source = image.crop((0, 0, crop_width, crop_height))
+        if source.size[0] >= width * 2 and source.size[1] >= height * 2:
+            source = source.resize((width * 2, height * 2), Image.NEAREST)
+        previous = source.resize((width, height), Image.ANTIALIAS)
+        yield width, height, previous
+
+
+# Output formats: extension and PIL format name
+IMAGE_FORMATS = {'png': (".png", "PNG"),
+                 'jpeg': (".jpg", "JPEG"),
+                 'jpg': (".jpg", "JPEG"),
+                 'webp': (".webp", "WEBP")}
+
+
+def save_image(fpath, image, width, height, image_format="png", compression=None, quality=None, drop_alpha=False):
+    image = as_image(image, width, height)
+    format = IMAGE_FORMATS[image_format][1]
+    options = {}
+    if format == "PNG" and compression:
+        options['compress_level'] = compression
+    if format in ("JPEG", "WEBP") and quality:
+        options['quality'] = quality
+    if drop_alpha or format == "JPEG":
+        image = image.convert("RGB")
+    # Write next to the destination and rename, readers never see a partial file
+    tmp_fpath = fpath + ".tmp"
+    image.save(tmp_fpath, format, **options)
+    os.rename(tmp_fpath, fpath)
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(','):
+        name, _, arg = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    date = parsedate_tz(value) if value else None
+    return mktime_tz(date) if date else None
+
+
+class StaticResponse:
+    """Stands in for the CEF response of a resource that wasn't fetched
+    with a WebRequest: served from the cache or stubbed."""
+
+    def __init__(self, entry):
+        self._entry = entry
+
+    def GetStatus(self):
+        return self._entry['status']
+
+    def GetStatusText(self):
+        return self._entry['status_text']
+
+    def GetMimeType(self):
+        return self._entry['mime_type']
+
+    def GetHeaderMap(self):
+        return dict(self._entry['headers'])
+
+    def GetHeaderMultimap(self):
+        return [tuple(header) for header in self._entry['headers']]
+
+
+class ResourceCache:
+    """On-disk cache of proxied resources shared by all jobs and workers.
+
+    Entries are keyed by the URL and the request headers named in the Vary
+    header of the response. Freshness follows Cache-Control and Expires,
+    stale entries with an ETag or Last-Modified are revalidated. The least
+    recently used entries are evicted above max_size bytes.
+
+    Lookups go to the directory, so entries stored by other workers are
+    found. The LRU index is rebuilt from the directory every
+    CACHE_SCAN_INTERVAL seconds, max_size holds across the workers give or
+    take what they stored in between.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._vary = {}  # url -> request headers the cached response varies on
+        self._entries = OrderedDict()  # key -> body size, least recently used first
+        self._size = 0
+        self._scanned = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._scan()
+        logging.info("Resource cache %s: %d entries, %d bytes" % (path, len(self._entries), self._size))
+
+    def _scan(self):
+        entries = []
+        for fname in os.listdir(self.path):
+            if fname.endswith('.json'):
+                key = fname[:-len('.json')]
+                try:
+                    mtime = os.stat(self._fpath(key, '.json')).st_mtime
+                    size = os.stat(self._fpath(key, '.body')).st_size
+                except OSError:
+                    continue  # evicted meanwhile
+                entries.append((mtime, key, size))
+        with self._lock:
+            self._entries = OrderedDict((key, size) for mtime, key, size in sorted(entries))
+            self._size = sum(self._entries.values())
+            self._scanned = time()
+
+    def _key(self, url, vary, requestHeaders):
+        headers = dict((k.lower(), v) for k, v in requestHeaders.items())
+        return hashlib.sha1("\n".join([url] + ["%s: %s" % (name, headers.get(name, ""))
+                                               for name in vary])).hexdigest()
+
+    def _fpath(self, key, ext):
+        return os.path.join(self.path, key + ext)
+
+    def _varyPath(self, url):
+        # The Vary header names of the responses of a URL, when there are some
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest() + '.vary')
+
+    def lookup(self, url, requestHeaders):
+        """Return the cached entry for the request or None, entry['fresh']
+        tells if it can be used without revalidation."""
+        with self._lock:
+            vary = self._vary.get(url)
+        if vary is None:
+            try:
+                with open(self._varyPath(url)) as f:
+                    vary = json.load(f)
+            except (IOError, ValueError):
+                vary = []
+        key = self._key(url, vary, requestHeaders)
+        try:
+            with open(self._fpath(key, '.json')) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None  # not cached, or evicted by another worker
+        with self._lock:
+            self._vary[url] = entry['vary']
+            if key not in self._entries:
+                # Stored by another worker since the last scan
+                self._entries[key] = entry['size']
+                self._size += entry['size']
+        entry['fresh'] = time() < entry['stored'] + entry['lifetime']
+        return entry
+
+    def body(self, entry):
+        try:
+            with open(self._fpath(entry['key'], '.body'), 'rb') as f:
+                body = f.read()
+        except IOError:
+            return None
+        with self._lock:
+            if entry['key'] in self._entries:
+                self._entries[entry['key']] = self._entries.pop(entry['key'])
+        # The meta file mtime keeps the LRU order across restarts
+        try:
+            os.utime(self._fpath(entry['key'], '.json'), None)
+        except OSError:
+            pass
+        return body
+
+    def refresh(self, entry, headerMap):
+        """A 304 Not Modified revalidated the entry."""
+        headers = dict((k.lower(), v) for k, v in headerMap.items())
+        lifetime = self._lifetime(headers)
+        entry['stored'] = time()
+        entry['lifetime'] = lifetime or 0
+        self._write(self._fpath(entry['key'], '.json'), json.dumps(entry))
+
+    def _lifetime(self, headers):
+        """Freshness lifetime in seconds, None if the response can't be stored."""
+        cacheControl = parse_cache_control(headers.get('cache-control', ""))
+        # The cache is shared by all jobs, private responses are per job
+        if 'no-store' in cacheControl or 'private' in cacheControl or headers.get('vary', "").strip() == '*':
+            return None
+        if 'no-cache' in cacheControl:
+            return 0
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cacheControl:
+                try:
+                    return max(0, int(cacheControl[directive]))
+                except ValueError:
+                    return 0
+        date = parse_http_date(headers.get('date')) or time()
+        expires = parse_http_date(headers.get('expires'))
+        if expires:
+            return max(0, expires - date)
+        lastModified = parse_http_date(headers.get('last-modified'))
+        if lastModified:
+            return max(0, (date - lastModified) / 10)  # usual heuristic
+        return 0
+
+    def store(self, url, requestHeaders, response, chunks):
+        headers = dict((k.lower(), v) for k, v in response.GetHeaderMap().items())
+        lifetime = self._lifetime(headers)
+        if lifetime is None or not (lifetime or 'etag' in headers or 'last-modified' in headers):
+            return
+        if 'authorization' in (k.lower() for k in requestHeaders):
+            # Like a shared HTTP cache, only when the response allows it explicitly
+            cacheControl = parse_cache_control(headers.get('cache-control', ""))
+            if not ('public' in cacheControl or 's-maxage' in cacheControl or 'must-revalidate' in cacheControl):
+                return
+        vary = sorted(name.strip().lower() for name in headers.get('vary', "").split(',') if name.strip())
+        key = self._key(url, vary, requestHeaders)
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_size:
+            return
+        entry = {'key': key,
+                 'url': url,
+                 'vary': vary,
+                 'size': size,
+                 'status': response.GetStatus(),
+                 'status_text': response.GetStatusText(),
+                 'mime_type': response.GetMimeType(),
+                 # Cookies set for a job must not be replayed to the others
+                 'headers': [header for header in response.GetHeaderMultimap() or []
+                             if header[0].lower() not in ('set-cookie', 'set-cookie2')],
+                 'etag': headers.get('etag'),
+                 'last_modified': headers.get('last-modified'),
+                 'stored': time(),
+                 'lifetime': lifetime}
+        self._write(self._fpath(key, '.body'), "".join(chunks))
+        self._write(self._fpath(key, '.json'), json.dumps(entry))
+        if vary:
+            self._write(self._varyPath(url), json.dumps(vary))
+        elif self._vary.get(url) != []:
+            try:
+                os.remove(self._varyPath(url))
+            except OSError:
+                pass
+        if time() - self._scanned > CACHE_SCAN_INTERVAL:
+            self._scan()
+        with self._lock:
+            self._vary[url] = vary
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            evicted = []
+            while self._size > self.max_size:
+                oldKey, oldSize = self._entries.popitem(last=False)
+                self._size -= oldSize
+                evicted.append(oldKey)
+        for oldKey in evicted:
+            try:
+                with open(self._fpath(oldKey, '.json')) as f:
+                    oldEntry = json.load(f)
+                if oldEntry['vary']:
+                    os.remove(self._varyPath(oldEntry['url']))
+            except (IOError, OSError, ValueError):
+                pass
+            for ext in ('.json', '.body'):
+                try:
+                    os.remove(self._fpath(oldKey, ext))
+                except OSError:
+                    pass
+
+    def _write(self, fpath, data):
+        tmp_fpath = "%s.%d.tmp" % (fpath, os.getpid())
+        with open(tmp_fpath, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_fpath, fpath)
+
+
+# Set by main() when --cache is given
+resource_cache = None
+
+
+class ResourceFilter:
+    """Blocking rules of a command compiled for fast matching:
+
+    {"domains": ["doubleclick.net", ...], "domain_lists": ["/path/hosts.txt"],
+     "urls": ["*.mp4", "re:/ads/"], "types": ["media", "font"],
+     "max_size": 1048576, "action": "cancel" or "stub"}
+
+    A domain also blocks its subdomains, domain lists have one domain per
+    line (hosts files work too). URL globs match the whole URL without its
+    query string and fragment, regexes are searched anywhere in the URL.
+    Globs and regexes are each merged in one regex.
+    """
+
+    def __init__(self, rules):
+        self._domains = {}  # trie of reversed labels, None marks a blocked domain
+        domains = list(rules.get('domains', []))
+        for fpath in rules.get('domain_lists', []):
+            with open(fpath) as f:
+                domains.extend(line.split()[-1] for line in f if line.strip() and not line.startswith('#'))
+        for domain in domains:
+            node = self._domains
+            for label in reversed(domain.lower().strip('.').split('.')):
+                node = node.setdefault(label, {})
+            node[None] = True
+        globs = [fnmatch.translate(url) for url in rules.get('urls', []) if not url.startswith('re:')]
+        regexes = [url[3:] for url in rules.get('urls', []) if url.startswith('re:')]
+        self._urlGlobs = re.compile('|'.join('(?:%s)' % pattern for pattern in globs)) if globs else None
+        self._urlRegexes = re.compile('|'.join('(?:%s)' % pattern for pattern in regexes)) if regexes else None
+        self._types = set(RESOURCE_TYPES[name] for name in rules.get('types', []) if name in RESOURCE_TYPES)
+        self.max_size = rules.get('max_size')
+        self.stub = rules.get('action') == "stub"
+
+    def _BlockedDomain(self, host):
+        node = self._domains
+        for label in reversed(host.lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def match(self, url, resourceType):
+        """Return why the request is blocked, None if it isn't."""
+        if resourceType in self._types:
+            return "type"
+        if self._domains and self._BlockedDomain(urlparse.urlsplit(url).hostname or ""):
+            return "domain"
+        if self._urlGlobs and self._urlGlobs.match(url.split('#', 1)[0].split('?', 1)[0]):
+            return "url"
+        if self._urlRegexes and self._urlRegexes.search(url):
+            return "url"
+        return None
+
+
+_resourceFilters = {}
+
+
+def get_resource_filter(rules):
+    # Jobs of a batch or worker usually share their rules, compile them once
+    key = json.dumps(rules, sort_keys=True)
+    if key not in _resourceFilters:
+        _resourceFilters[key] = ResourceFilter(rules)
+    return _resourceFilters[key]
+
+
+class ProxyPool:
+    """Rotates over proxies and keeps their health and latency across jobs
+    in a small JSON state file, shared by all processes using it.
+
+    A proxy that failed PROXY_MAX_FAILURES times in a row is tried last
+    until PROXY_COOLDOWN seconds after its last failure.
+    """
+
+    def __init__(self, fpath=None):
+        self.fpath = fpath
+        self.state = {'next': 0, 'proxies': {}}
+
+    def _update(self, change):
+        # Apply change(state) under an exclusive lock of the state file
+        if not self.fpath:
+            change(self.state)
+            return
+        with open(self.fpath + ".lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.fpath) as f:
+                    self.state = json.load(f)
+            except (IOError, ValueError):
+                pass
+            change(self.state)
+            tmp_fpath = "%s.%d.tmp" % (self.fpath, os.getpid())
+            save_json(tmp_fpath, self.state)
+            os.rename(tmp_fpath, self.fpath)
+
+    def order(self, proxies):
+        """The proxies in the order to try them for the next job."""
+        ordered = []
+
+        def rotate(state):
+            start = state['next'] % len(proxies)
+            state['next'] += 1
+            now = time()
+
+            def unhealthy(proxy):
+                stats = state['proxies'].get(proxy, {})
+                return (stats.get('consecutive_failures', 0) >= PROXY_MAX_FAILURES
+                        and now - stats.get('last_failure', 0) < PROXY_COOLDOWN)
+            ordered.extend(sorted(proxies[start:] + proxies[:start], key=unhealthy))
+        self._update(rotate)
+        return ordered
+
+    def record(self, proxy, ok, latency):
+        def update(state):
+            stats = state['proxies'].setdefault(proxy, {'ok': 0, 'failed': 0, 'consecutive_failures': 0,
+                                                        'latency': None})
+            if ok:
+                stats['ok'] += 1
+                stats['consecutive_failures'] = 0
+                if stats['latency'] is None:
+                    stats['latency'] = round(latency, 3)
+                else:  # moving average
+                    stats['latency'] = round(0.8 * stats['latency'] + 0.2 * latency, 3)
+            else:
+                stats['failed'] += 1
+                stats['consecutive_failures'] += 1
+                stats['last_failure'] = time()
+        self._update(update)
+
+
+def proxy_failed(metadata):
+    # Errors worth retrying on another proxy: the page didn't load at all
+    return metadata['error'] == "Timeout" or 'error_code' in metadata
 
 
 class ResourceHandler:
@@ -56,7 +596,16 @@ class ResourceHandler:
     _responseHeadersReadyCallback = None
     _webRequest = None
     _webRequestClient = None
-    _offsetRead = 0
+    # Read position in the chunks of _webRequestClient
+    _chunkIndex = 0
+    _chunkOffset = 0
+    # Streaming: callback of a ReadResponse() that found no data yet
+    _readCallback = None
+    # Why the request is blocked by the command rules, and the max_size
+    # rule, which doesn't apply to the page itself
+    _blocked = None
+    _maxSize = None
+    _started = None
 
     def ProcessRequest(self, request, callback):
         # 1. Start the request using WebRequest
@@ -66,6 +615,14 @@ class ResourceHandler:
         self._responseHeadersReadyCallback = callback
         self._webRequestClient = WebRequestClient()
         self._webRequestClient._resourceHandler = self
+        self._webRequestClient._streaming = bool(self._command.get('stream'))
+        if self._blocked:
+            self._clientHandler._CountBlocked(self._blocked)
+            if not self._clientHandler.resourceFilter.stub:
+                self._clientHandler._ReleaseStrongReference(self)
+                return False  # cancels the request
+            self._webRequestClient._Stub(request)
+            return True
         # Need to set AllowCacheCredentials and AllowCookies for
         # the cookies to work during POST requests (Issue 127).
         # To skip cache set the SkipCache request flag.
@@ -76,12 +633,42 @@ class ResourceHandler:
             headers.update(self._command['headers'])
             request.SetHeaderMap(headers)
 
+        if resource_cache and request.GetMethod() == "GET":
+            if self._ProcessCachedRequest(request):
+                return True
 
         # A strong reference to the WebRequest object must kept.
         self._webRequest = cefpython.WebRequest.Create(
             request, self._webRequestClient)
+        self._webRequestClient._inFlight = True
+        self._clientHandler._NetworkActivity(1)
         return True
 
+    def _ProcessCachedRequest(self, request):
+        # Serve a fresh cache entry right away, or make the request
+        # conditional when the stale entry can be revalidated.
+        url = request.GetUrl()
+        headers = request.GetHeaderMap()
+        entry = resource_cache.lookup(url, headers)
+        self._webRequestClient._cacheable = True
+        if entry and entry['fresh']:
+            body = resource_cache.body(entry)
+            if body is not None:
+                self._clientHandler._CountCache('hits', len(body))
+                self._webRequestClient._Complete(request, cefpython.WebRequest.Status["Success"],
+                                                 0, StaticResponse(entry), [body], "cache")
+                return True
+        if entry and (entry['etag'] or entry['last_modified']):
+            self._webRequestClient._cacheEntry = entry
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            request.SetHeaderMap(headers)
+        else:
+            self._clientHandler._CountCache('misses')
+        return False
+
     def GetResponseHeaders(self, response, responseLengthOut, redirectUrlOut):
         # 1. If the response length is not known set
         #    responseLengthOut[0] to -1 and ReadResponse()
@@ -117,16 +704,36 @@ class ResourceHandler:
         #    bytesReadOut[0] to 0, return true and call
         #    callback.Continue() when the data is available.
         # 3. To indicate response completion return false.
-        if self._offsetRead < self._webRequestClient._dataLength:
-            dataChunk = self._webRequestClient._data[ \
-                        self._offsetRead:(self._offsetRead + bytesToRead)]
-            self._offsetRead += len(dataChunk)
+        chunks = self._webRequestClient._chunks
+        while self._chunkIndex < len(chunks):
+            chunk = chunks[self._chunkIndex]
+            if not self._chunkOffset and len(chunk) <= bytesToRead:
+                dataChunk = chunk  # whole chunk, no copy
+            else:
+                dataChunk = memoryview(chunk)[self._chunkOffset:(self._chunkOffset + bytesToRead)].tobytes()
+            self._chunkOffset += len(dataChunk)
+            if self._chunkOffset >= len(chunk):
+                self._chunkIndex += 1
+                self._chunkOffset = 0
+            if not dataChunk:
+                continue
             dataOut[0] = dataChunk
             bytesReadOut[0] = len(dataChunk)
             return True
+        if not self._webRequestClient._complete:
+            # Streaming, WebRequestClient calls Continue() on new data
+            self._readCallback = callback
+            bytesReadOut[0] = 0
+            return True
         self._clientHandler._ReleaseStrongReference(self)
         return False
 
+    def _DataAvailable(self):
+        if self._readCallback:
+            callback = self._readCallback
+            self._readCallback = None
+            callback.Continue()
+
     def CanGetCookie(self, cookie):
         # Return true if the specified cookie can be sent
         # with the request or false otherwise. If false
@@ -141,15 +748,36 @@ class ResourceHandler:
 
     def Cancel(self):
         # Request processing has been canceled.
-        pass
+        if self._webRequest:
+            self._webRequest.Cancel()
 
 
 class WebRequestClient:
 
     _resourceHandler = None
-    _data = ""
+    # The body is kept as the list of received chunks, appending to a
+    # string is quadratic for large resources.
+    _chunks = None
     _dataLength = -1
     _response = None
+    # In streaming mode the response headers are sent to CEF with the
+    # first chunk and data is handed over as it arrives.
+    _streaming = False
+    _headersSent = False
+    _complete = False
+    # Resource cache: whether the response may be stored, and the stale
+    # entry being revalidated
+    _cacheable = False
+    _cacheEntry = None
+    # Canceled for exceeding the max_size blocking rule
+    _tooLarge = False
+    # Counted in the in-flight requests of the client handler
+    _inFlight = False
+    _firstByte = None
+
+    def __init__(self):
+        self._chunks = []
+        self._received = 0
 
     def OnUploadProgress(self, webRequest, current, total):
         pass
@@ -158,7 +786,52 @@ class WebRequestClient:
         pass
 
     def OnDownloadData(self, webRequest, data):
-        self._data += data
+        if self._firstByte is None:
+            self._firstByte = time()
+        self._chunks.append(data)
+        self._received += len(data)
+        self._resourceHandler._clientHandler._NetworkActivity()
+        maxSize = self._resourceHandler._maxSize
+        if maxSize and self._received > maxSize:
+            if not self._tooLarge:
+                self._tooLarge = True
+                self._resourceHandler._clientHandler._CountBlocked("max_size")
+                webRequest.Cancel()
+            return
+        if self._streaming:
+            if not self._headersSent:
+                self._response = webRequest.GetResponse()
+                self._SendHeaders()
+            self._resourceHandler._DataAvailable()
+
+    def _Stub(self, request):
+        # Answer with an empty response instead of fetching the resource
+        response = StaticResponse({'status': 200, 'status_text': "OK", 'mime_type': "text/plain", 'headers': []})
+        self._Complete(request, cefpython.WebRequest.Status["Success"], 0, response, [], "stub")
+
+    def _Refetch(self, conditionalRequest):
+        # Send the request again without the revalidation headers
+        headers = conditionalRequest.GetHeaderMap()
+        for name in ('If-None-Match', 'If-Modified-Since'):
+            headers.pop(name, None)
+        request = cefpython.Request.CreateRequest()
+        request.SetUrl(conditionalRequest.GetUrl())
+        request.SetMethod("GET")
+        request.SetHeaderMap(headers)
+        request.SetFlags(conditionalRequest.GetFlags())
+        self._cacheEntry = None
+        self._chunks = []
+        self._received = 0
+        self._firstByte = None
+        self._resourceHandler._webRequest = cefpython.WebRequest.Create(request, self)
+        self._inFlight = True
+        self._resourceHandler._clientHandler._NetworkActivity(1)
+
+    def _SendHeaders(self):
+        # ResourceHandler.GetResponseHeaders() will get called
+        # after _responseHeadersReadyCallback.Continue() is called.
+        self._headersSent = True
+        self._resourceHandler._responseHeadersReadyCallback.Continue()
 
     def OnRequestComplete(self, webRequest):
         # cefpython.WebRequest.Status = {"Unknown", "Success",
@@ -168,24 +841,74 @@ class WebRequestClient:
             statusText = cefpython.WebRequest.Status[webRequest.GetRequestStatus()]
         #print("status = %s" % statusText)
         #print("error code = %s" % webRequest.GetRequestError())
+        if self._inFlight:
+            self._inFlight = False
+            self._resourceHandler._clientHandler._NetworkActivity(-1)
+        if self._tooLarge:
+            if not self._headersSent and self._resourceHandler._clientHandler.resourceFilter.stub:
+                self._Stub(webRequest.GetRequest())
+            elif not self._headersSent:
+                # Like a blocked request, the renderer sees it fail
+                self._resourceHandler._responseHeadersReadyCallback.Cancel()
+                self._resourceHandler._clientHandler._ReleaseStrongReference(self._resourceHandler)
+            else:
+                self._complete = True
+                self._resourceHandler._DataAvailable()
+            return
+        response = webRequest.GetResponse()
+        chunks = self._chunks
+        source = "network"
+        if self._cacheEntry:
+            body = None
+            if response.GetStatus() == 304:
+                body = resource_cache.body(self._cacheEntry)
+                if body is None:
+                    # Evicted since the lookup, the page didn't ask for a 304
+                    self._resourceHandler._clientHandler._CountCache('misses')
+                    self._Refetch(webRequest.GetRequest())
+                    return
+            if body is not None:
+                self._resourceHandler._clientHandler._CountCache('revalidated', len(body))
+                resource_cache.refresh(self._cacheEntry, response.GetHeaderMap())
+                response = StaticResponse(self._cacheEntry)
+                chunks = [body]
+                source = "revalidated"
+            else:
+                self._resourceHandler._clientHandler._CountCache('misses')
+        if self._cacheable and response.GetStatus() == 200 and not isinstance(response, StaticResponse):
+            resource_cache.store(webRequest.GetRequest().GetUrl(), webRequest.GetRequest().GetHeaderMap(),
+                                 response, chunks)
+        self._Complete(webRequest.GetRequest(), webRequest.GetRequestStatus(),
+                       webRequest.GetRequestError(), response, chunks, source)
+
+    def _Complete(self, request, requestStatus, requestError, response, chunks, source):
         # Emulate OnResourceResponse() in ClientHandler:
-        self._response = webRequest.GetResponse()
+        self._response = response
         # Are webRequest.GetRequest() and
         # self._resourceHandler._request the same? What if
         # there was a redirect, what will GetUrl() return
         # for both of them?
-        self._data = self._resourceHandler._clientHandler._OnResourceResponse(
+        chunks = self._resourceHandler._clientHandler._OnResourceResponse(
             self._resourceHandler._browser,
             self._resourceHandler._frame,
-            webRequest.GetRequest(),
-            webRequest.GetRequestStatus(),
-            webRequest.GetRequestError(),
-            webRequest.GetResponse(),
-            self._data)
-        self._dataLength = len(self._data)
-        # ResourceHandler.GetResponseHeaders() will get called
-        # after _responseHeadersReadyCallback.Continue() is called.
-        self._resourceHandler._responseHeadersReadyCallback.Continue()
+            request,
+            requestStatus,
+            requestError,
+            response,
+            chunks)
+        if not self._headersSent:
+            # When streaming, the chunks were already handed over as they
+            # arrived and can't be changed anymore.
+            self._chunks = chunks
+        self._dataLength = sum(len(chunk) for chunk in self._chunks)
+        self._complete = True
+        self._resourceHandler._clientHandler._RecordResource(
+            request.GetUrl(), response.GetStatus(), self._dataLength, self._received,
+            self._resourceHandler._started, self._firstByte, source)
+        if not self._headersSent:
+            self._SendHeaders()
+        else:
+            self._resourceHandler._DataAvailable()
 
 
 class ClientHandler:
@@ -194,20 +917,175 @@ class ClientHandler:
     command = None
     doneEnd = False
     isLoading = True
+    # Tiled capture of size=page: the view stays tileHeight high and the
+    # page is scrolled tile by tile into pageImage.
+    tileHeight = None
+    pageHeight = None
+    pageImage = None
+    tileOffset = None
+    tilesStart = None
+    resourceFilter = None
+    # Network and paint activity for the idle_time completion
+    requestsInFlight = 0
+    lastActivity = 0
+    idleCapture = False
+    captured = False
+    # BGRA copy of the view kept up to date from the dirty rectangles
+    paintBuffer = None
+    paintSize = None
+    paintBytes = 0
+    paints = 0
+    shotsTaken = 0
+    nextShot = None
+    shotCallback = None  # called with (number, image) for every shot but the last
 
     def __init__(self, browser, command):
         self.browser = browser
         self.command = command
+        self.created = time()
+        self.loadEnd = None
+        if command.get('size', "screen") != "screen" and 'tile_height' in command:
+            self.tileHeight = command['tile_height']
+        self.resourceFilter = get_resource_filter(command['block']) if 'block' in command else None
+        # Per browser, several handlers are alive at the same time
+        self._resourceHandlers = {}
+        self._resourceHandlerMaxId = 0
+
+    # The JS callbacks are bound per browser (see create_browser) so that
+    # several browsers can be in flight in the same process.
+
+    def setPageSize(self, width, height):
+        if self.tileHeight:
+            self.pageHeight = height
+            height = min(height, self.tileHeight)
+        self.browser.SetUserData("width", width)
+        self.browser.SetUserData("height", height)
+        self.browser.WasResized()
+
+    def jsCallback(self, html):
+        if self.captured:
+            return  # the delay expired after an idle capture
+        self.captured = True
+        start = time()
+        browser = self.browser
+        metadata = browser.GetUserData("metadata")
+        metadata['final_url'] = browser.GetUrl()
+        browser.SetUserData("metadata", metadata)
+        browser.SetUserData("html", html)
+        if self.pageHeight:
+            self.tilesStart = time()
+            self._ScrollToTile(0)
+        else:
+            self._TakeShot()
+        metadata['timings']['delay'] = round(start - (self.loadEnd or start), 4)
+        metadata['timings']['capture'] = round(time() - start, 4)
+
+    def _TakeShot(self):
+        # With shots > 1 the earlier shots are handed to shotCallback to be
+        # encoded while waiting for the next one, the last shot is the image
+        image = self.CaptureImage()
+        self.shotsTaken += 1
+        if self.shotsTaken < self.command.get('shots', 1) and self.shotCallback:
+            self.shotCallback(self.shotsTaken, image)
+            self.nextShot = time() + self.command.get('shot_interval', 1)
+            return
+        self.nextShot = None
+        self.browser.SetUserData("image", image)
+        self.browser.SetUserData("done", True)
+
+    def _ScrollToTile(self, y):
+        # Give the renderer a frame and a little time to paint the scrolled view
+        self.browser.GetMainFrame().ExecuteJavascript(
+            "window.scrollTo(0, %d); requestAnimationFrame(function() {"
+            " setTimeout(function() { tileCallback(window.pageYOffset); }, %d); });"
+            % (y, TILE_SETTLE_TIME * 1000))
+
+    def tileCallback(self, offset):
+        browser = self.browser
+        width = browser.GetUserData("width")
+        height = browser.GetUserData("height")
+        tile = self.CaptureImage()
+        if tile is None:
+            self._ScrollToTile(offset)  # not painted yet
+            return
+        if self.pageImage is None:
+            logging.info("Capturing %dx%d page in tiles of %dpx" % (width, self.pageHeight, height))
+            self.pageImage = Image.new("RGBA", (width, self.pageHeight))
+        self.pageImage.paste(tile, (0, offset))
+        next_offset = offset + height
+        if next_offset < self.pageHeight and offset != self.tileOffset:
+            self.tileOffset = offset
+            self._ScrollToTile(next_offset)
+            return
+        # The page can't scroll further, the stitched image is complete
+        metadata = browser.GetUserData("metadata")
+        metadata['timings']['tiles'] = round(time() - self.tilesStart, 4)
+        browser.SetUserData("height", self.pageHeight)
+        browser.SetUserData("image", self.pageImage)
+        browser.SetUserData("done", True)
+
+    def _NetworkActivity(self, requests=0):
+        # Called on the IO thread, the UI thread only reads these
+        self.requestsInFlight += requests
+        self.lastActivity = time()
+
+    def Poll(self):
+        """Called from the message loop, captures the page once the network
+        and painting have been idle for idle_time milliseconds after the load
+        event. The delay is still the upper bound. Also takes the following
+        shots of a multi-shot capture."""
+        if self.nextShot and time() >= self.nextShot:
+            self._TakeShot()
+            return
+        idleTime = self.command.get('idle_time')
+        if not idleTime or self.idleCapture or self.captured or not self.doneEnd:
+            return
+        if self.requestsInFlight or time() - self.lastActivity < idleTime / 1000.0:
+            return
+        self.idleCapture = True
+        logging.info("Network and paint idle for %dms" % idleTime)
+        self.browser.GetMainFrame().ExecuteJavascript("jsCallback(document.documentElement.innerHTML);")
 
     def OnPaint(self, browser, paintElementType, dirtyRects, buffer, bufferWidth, bufferHeight):
+        self.lastActivity = time()
+        if browser.GetUserData("done"):
+            return
         if paintElementType == cefpython.PET_POPUP:
             return
         elif paintElementType == cefpython.PET_VIEW:
-            image = buffer.GetString(mode="rgba", origin="top-left")
-            browser.SetUserData("image", image)
+            # Only the dirty rectangles are copied into a persistent BGRA
+            # buffer, the image is converted once at capture time.
+            rowSize = bufferWidth * 4
+            if self.paintSize != (bufferWidth, bufferHeight):
+                self.paintSize = (bufferWidth, bufferHeight)
+                self.paintBuffer = bytearray(rowSize * bufferHeight)
+                dirtyRects = [[0, 0, bufferWidth, bufferHeight]]
+            source = buffer.GetIntPointer()
+            destination = ctypes.addressof(ctypes.c_char.from_buffer(self.paintBuffer))
+            for x, y, width, height in dirtyRects:
+                right, bottom = min(x + width, bufferWidth), min(y + height, bufferHeight)
+                x, y = max(0, x), max(0, y)
+                width, height = right - x, bottom - y
+                if width <= 0 or height <= 0:
+                    continue
+                if x == 0 and width == bufferWidth:
+                    offset = y * rowSize
+                    ctypes.memmove(destination + offset, source + offset, height * rowSize)
+                else:
+                    for row in range(y, y + height):
+                        offset = row * rowSize + x * 4
+                        ctypes.memmove(destination + offset, source + offset, width * 4)
+                self.paintBytes += width * height * 4
+            self.paints += 1
         else:
             raise Exception("Unknown paintElementType: %s" % paintElementType)
 
+    def CaptureImage(self):
+        """RGBA image of the view as last painted, None before the first paint."""
+        if self.paintBuffer is None:
+            return None
+        return Image.frombuffer("RGBA", self.paintSize, self.paintBuffer, "raw", "BGRA", 0, 1)
+
     def GetViewRect(self, browser, rect):
         width = browser.GetUserData("width")
         height = browser.GetUserData("height")
@@ -225,10 +1103,12 @@ class ClientHandler:
             return
 
         self.doneEnd = True
+        self.lastActivity = self.loadEnd = time()
         metadata = browser.GetUserData("metadata")
+        metadata['timings']['navigation'] = round(self.loadEnd - self.created, 4)
         if httpStatusCode != 200:
             metadata['error'] = "Failed loading page got status code %s" % httpStatusCode
-            cefpython.QuitMessageLoop()
+            browser.SetUserData("done", True)
             return
         logging.info("Finished loading page")
         metadata['loaded'] = 1
@@ -267,8 +1147,9 @@ class ClientHandler:
     def OnLoadError(self, browser, frame, errorCode, errorText, failedURL):
         metadata = browser.GetUserData("metadata")
         metadata['error'] = errorText
+        metadata['error_code'] = errorCode
         browser.SetUserData("metadata", metadata)
-        cefpython.QuitMessageLoop()
+        browser.SetUserData("done", True)
 
     def GetCookieManager(self, browser, mainUrl):
         cookieManager = browser.GetUserData("cookieManager")
@@ -287,15 +1168,47 @@ class ClientHandler:
         resHandler._browser = browser
         resHandler._frame = frame
         resHandler._request = request
+        resHandler._started = time()
+        if self.resourceFilter and request.GetResourceType() != RESOURCE_TYPES['main_frame']:
+            resHandler._blocked = self.resourceFilter.match(request.GetUrl(), request.GetResourceType())
+            resHandler._maxSize = self.resourceFilter.max_size
         self._AddStrongReference(resHandler)
         return resHandler
 
-    def _OnResourceResponse(self, browser, frame, request, requestStatus, requestError, response, data):
+    def _OnResourceResponse(self, browser, frame, request, requestStatus, requestError, response, chunks):
+        # |chunks| is the list of the response body chunks, return it
+        # or a modified list.
         metadata = browser.GetUserData("metadata")
         metadata['content_type'] = response.GetMimeType()
         metadata['status']= response.GetStatusText()
         browser.SetUserData("metadata", metadata)
-        return data
+        return chunks
+
+    def _RecordResource(self, url, status, size, received, started, firstByte, source):
+        metadata = self.browser.GetUserData("metadata")
+        metadata['requests'] = metadata.get('requests', 0) + 1
+        metadata['bytes_downloaded'] = metadata.get('bytes_downloaded', 0) + received
+        if self.command.get('timings'):
+            now = time()
+            metadata.setdefault('resources', []).append({
+                'url': url,
+                'status': status,
+                'bytes': size,
+                'source': source,
+                'start': round(started - self.created, 4),
+                'ttfb': round(firstByte - started, 4) if firstByte else None,
+                'duration': round(now - started, 4)})
+
+    def _CountBlocked(self, reason):
+        metadata = self.browser.GetUserData("metadata")
+        blocked = metadata.setdefault('blocked', {})
+        blocked[reason] = blocked.get(reason, 0) + 1
+
+    def _CountCache(self, counter, savedBytes=0):
+        metadata = self.browser.GetUserData("metadata")
+        stats = metadata.setdefault('cache', {'hits': 0, 'misses': 0, 'revalidated': 0, 'bytes_saved': 0})
+        stats[counter] += 1
+        stats['bytes_saved'] += savedBytes
 
     # A strong reference to ResourceHandler must be kept
     # during the request. Some helper functions for that.
@@ -320,7 +1233,16 @@ class ClientHandler:
 
 
 def print_usage():
-    print "Usage: python " + sys.argv[0] + " <input file>"
+    print "Usage: python " + sys.argv[0] + " <input file> [--proxy <host,...>] [--concurrency <browsers>]"
+    print "              [--encoders <threads>] [--cache <directory>] [--cache-size <MB>]"
+    print "              [--proxy-state <file>] [--metrics-port <port>] [--metrics-address <address>]"
+    print "              [--event-log <file>] [--store <directory>] [--store-compression <gzip|zstd>]"
+    print "       python " + sys.argv[0] + " --spool <directory> [--proxy <host,...>] [--poll-interval <seconds>]"
+    print "              [--concurrency <browsers>] [--encoders <threads>] [--cache <directory>]"
+    print "              [--cache-size <MB>] [--proxy-state <file>] [--metrics-port <port>]"
+    print "              [--metrics-address <address>] [--event-log <file>] [--domain-limit <jobs>]"
+    print "              [--domain-delay <seconds>] [--max-jobs <jobs>] [--max-rss <MB>] [--store <directory>]"
+    print "              [--store-compression <gzip|zstd>]"
     print"""
 The input file contains JSON data in this format:
 {"post_data":"","delay":"6","file":"/tmp/1400469755-c8f149c0ecbafcde1b083619fb99c186-60-
@@ -330,10 +1252,35 @@ The input file contains JSON data in this format:
 
 - post_data: option POST DATA to be send with the URL
 - delay: time to wait in seconds after the page load event to take a screenshot
+- idle_time: optional, take the screenshot as soon as no request was in flight and nothing was
+painted for this many milliseconds after the page load event, delay is then an upper bound
 - flash_delay: time to wait in seconds after the page load event to take a screenshot if Flash
 elements are present in the page
 - file: base file name to save the screenshot and metadata
 - size: size of the screenshot: screen (visible browser size) or page (full page)
+- tile_height: with size page, capture the page in tiles of this height instead of resizing the
+view to the whole page, avoids huge paint buffers and blank renders on very tall pages
+- format: image format, png (default), jpeg or webp
+- compression: PNG compression level from 1 (fastest) to 9 (smallest)
+- quality: JPEG/WebP quality
+- drop_alpha: 1 to save RGB instead of RGBA
+- thumbnails: optional list of thumbnail sizes, [width, height] pairs or "<width>x<height>"
+strings, saved as <file>_<width>x<height>.<format>. thumbalizr with width and height adds one
+- shots: number of screenshots to take from one page load, shot_interval seconds apart (default
+1), the earlier shots are saved as <file>_<n>.<format> while waiting for the next one, the last
+is the screenshot <file>.<format>, all of them are listed in the "shot_files" metadata. Ignored
+with tile_height
+- previous_hash, previous_phash: optional image_hash and image_phash metadata of a previous
+run, the screenshot and thumbnails are not saved and "unchanged" is set in the metadata when
+the new screenshot has the same hash or its perceptual hash differs by at most phash_distance
+bits (default 0)
+- stream: 1 to hand resources to the renderer as they download instead of after completion
+- block: optional rules to cancel or stub requests before they hit the network, e.g.
+{"domains": ["doubleclick.net"], "domain_lists": ["/etc/trackers.txt"], "urls": ["*.mp4",
+"re:/ads/"], "types": ["media", "font"], "max_size": 1048576, "action": "stub"}
+URL globs match the URL without its query string, "re:" regexes are searched anywhere in it,
+max_size doesn't apply to the page itself. Counts of blocked requests by reason are in the
+"blocked" metadata
 - html: 1 if the rendered HTML needs to be saved, 0 otherwise
 - url: URL of the page to load
 - referer: optional Referrer header
@@ -342,137 +1289,552 @@ elements are present in the page
 - script: option URL of Javascript file to execute inside the browser
 - cookie: optional Cookie header
 - details: level of details in the metadata
-- timeout: timeout in seconds
+- timings: 1 to add the timings and sizes of every resource to the metadata, the timings of the
+phases of the job (browser_create, navigation, delay, capture, encode...) are always there
+- timeout: timeout in seconds, the HTML and screenshot captured so far are still saved with
+"partial" in the metadata
+- priority: optional, in spool mode commands with a higher priority are snapshotted first
+(default 0)
+- instance_id: optional, in spool mode the instances share the browsers fairly
+
+The input file can also be a batch: a JSON array of commands or one command per line (JSON
+Lines), use "-" to read JSON Lines from stdin. The outputs of each job are written as soon as
+it completes.
+
+The proxies of a single command are rotated across runs, a page that fails to load is retried
+through the next proxy, each attempt in its own process. Health and latency of the proxies are
+kept in the --proxy-state file (default pycefsnap-proxies.json in the temp directory). Batches
+and spool workers use one proxy per process, the first healthy one of --proxy in rotation, their
+commands with proxies fail unless that proxy is one of them.
+
+Batches and spool workers can serve Prometheus metrics on http://<address>:<port>/metrics
+(jobs by result: ok, timeout, load_error, http_status, other; latency histogram; bytes
+downloaded; RSS of the process and of the CEF subprocesses) and append one JSON line per event
+(worker_started, job_finished, worker_stopped, worker_killed) to --event-log. A batch or spool
+worker whose message loop is stuck in CEF past a job timeout saves the partial outputs of its
+jobs and kills itself along with its CEF subprocesses.
+
+With --spool the process keeps CEF initialized and snapshots every command file (*.json)
+dropped in the spool directory until it gets SIGTERM/SIGINT. Files are claimed by renaming
+them to *.json.working so several workers can share a spool. --concurrency sets how many
+off-screen browsers render at the same time in the worker (default 1). Commands with a higher
+priority are started first, then the instance_id with the fewest jobs in flight, then the oldest
+file. At most --domain-limit jobs (default 2) of a domain are in flight and --domain-delay seconds
+(default 0) separate their starts, across all the workers of the spool. A worker recycles itself,
+restarting with a fresh CEF once its jobs in flight are done, after --max-jobs jobs or when the
+RSS of the process and its CEF subprocesses is above --max-rss MB after a job. The peak RSS while
+a job was in flight is in the "peak_rss" metadata. In batch and spool mode
+images are encoded by a pool of --encoders threads (default 2) while the next pages render, the
+.finished file of a job is written once its image is in place.
+
+--cache keeps the resources of the pages in a directory shared by all jobs and workers, following
+Cache-Control/Expires and revalidating with ETag/Last-Modified, evicting the least recently used
+above --cache-size (default 512MB). Hits, misses and bytes saved are in the "cache" metadata.
+
+--store writes the HTML and metadata of the jobs to a directory instead of the .html and .finished
+files: HTML compressed with --store-compression (gzip, the default, or zstd with the zstandard
+module) once per identical body as html/<xx>/<sha1>.html.gz, referenced by "html_hash" and
+"html_file" in the metadata, and metadata appended to metadata-<YYYYMMDD>.jsonl (UTC), one JSON
+object per job. Screenshots are still written to their file.
 """
 
 
-def setPageSize(width, height):
-    browser = cefpython.GetBrowserByWindowHandle(0)
+def initialize(proxy=None):
+    cefpython.g_debug = False
+    commandLineSwitches = dict()
+    if proxy:
+        logging.info("Proxy server: %s:1080" % proxy)
+        commandLineSwitches['proxy-server'] = "socks5://" + proxy + ":1080"
+    settings = {
+        "log_severity": cefpython.LOGSEVERITY_DISABLE,  # LOGSEVERITY_VERBOSE
+        "log_file": "",
+        "release_dcheck_enabled": False, # Enable only when debugging.
+        # This directories must be set on Linux
+        "locales_dir_path": cefpython.GetModuleDirectory()+"/locales",
+        "resources_dir_path": cefpython.GetModuleDirectory(),
+        "multi_threaded_message_loop": False,
+        "unique_request_context_per_browser": True,
+        "browser_subprocess_path": "%s/%s" % (
+            cefpython.GetModuleDirectory(), "subprocess")
+    }
+    cefpython.Initialize(settings, commandLineSwitches)
+
+
+def create_browser(command, width, height, metadata):
+    windowInfo = cefpython.WindowInfo()
+    windowInfo.SetAsOffscreen(0)
+    browserSettings = {"default_encoding": "utf-8"}
+    browser = cefpython.CreateBrowserSync(windowInfo, browserSettings, navigateUrl=command['url'])
+    cookieManager = cefpython.CookieManager.CreateManager("")
+    if 'cookie' in command:
+        for k, v in command['cookie'].items():
+            cookie = cefpython.Cookie()
+            cookie.SetName(k)
+            cookie.SetValue(v)
+            cookie.SetHasExpires(False)
+            cookieManager.SetCookie(command['url'], cookie)
+    browser.SetUserData("cookieManager", cookieManager)
+    #browser = cefpython.CreateBrowserSync(windowInfo, browserSettings, navigateUrl="about:blank")
+    # TODO handle post data
+    #req = cefpython.Request.CreateRequest()
+    #req.SetUrl(command['url'])
+    # req.SetMethod("POST")
+    # a = req.SetPostData([])
+    #browser.GetMainFrame().LoadRequest(req)
+
+    browser.SendFocusEvent(True)
     browser.SetUserData("width", width)
     browser.SetUserData("height", height)
-    browser.WasResized()
-
-
-def jsCallback(html):
-    browser = cefpython.GetBrowserByWindowHandle(0)
-    metadata = browser.GetUserData("metadata")
-    metadata['final_url'] = browser.GetUrl()
     browser.SetUserData("metadata", metadata)
-    browser.SetUserData("html", html)
-    cefpython.QuitMessageLoop()
-
-
-def snap(command, width=800, height=600):
-    metadata = {}
-    try:
-        logging.info("Snapshot url: %s" % command['url'])
-        metadata['timestamp'] = int(time())
-        metadata['error'] = "0"
-        parent_dir = os.path.dirname(command['file'])
-        if parent_dir and not os.path.exists(parent_dir):
-            os.makedirs(parent_dir)
-        if 'screen_width' in command:
-            width = command['screen_width']
-        if 'screen_height' in command:
-            height = command['screen_height']
-        cefpython.g_debug = False
-        commandLineSwitches = dict()
-        if 'proxies' in command:
-            proxy = command['proxies'][0]
-            logging.info("Proxy server: %s:1080" % proxy)
-            commandLineSwitches['proxy-server'] = "socks5://" + proxy + ":1080"
-        settings = {
-            "log_severity": cefpython.LOGSEVERITY_DISABLE,  # LOGSEVERITY_VERBOSE
-            "log_file": "",
-            "release_dcheck_enabled": False, # Enable only when debugging.
-            # This directories must be set on Linux
-            "locales_dir_path": cefpython.GetModuleDirectory()+"/locales",
-            "resources_dir_path": cefpython.GetModuleDirectory(),
-            "multi_threaded_message_loop": False,
-            "unique_request_context_per_browser": True,
-            "browser_subprocess_path": "%s/%s" % (
-                cefpython.GetModuleDirectory(), "subprocess")
-        }
-        cefpython.Initialize(settings, commandLineSwitches)
-        windowInfo = cefpython.WindowInfo()
-        windowInfo.SetAsOffscreen(0)
-        browserSettings = {"default_encoding": "utf-8"}
-        browser = cefpython.CreateBrowserSync(windowInfo, browserSettings, navigateUrl=command['url'])
-        cookieManager = cefpython.CookieManager.CreateManager("")
-        if 'cookie' in command:
-            for k, v in command['cookie'].items():
-                cookie = cefpython.Cookie()
-                cookie.SetName(k)
-                cookie.SetValue(v)
-                cookie.SetHasExpires(False)
-                cookieManager.SetCookie(command['url'], cookie)
-        browser.SetUserData("cookieManager", cookieManager)
-        #browser = cefpython.CreateBrowserSync(windowInfo, browserSettings, navigateUrl="about:blank")
-        # TODO handle post data
-        #req = cefpython.Request.CreateRequest()
-        #req.SetUrl(command['url'])
-        # req.SetMethod("POST")
-        # a = req.SetPostData([])
-        #browser.GetMainFrame().LoadRequest(req)
-
-        browser.SendFocusEvent(True)
-        browser.SetUserData("width", width)
-        browser.SetUserData("height", height)
-        browser.SetUserData("metadata", metadata)
-        browser.SetClientHandler(ClientHandler(browser, command))
-        jsBindings = cefpython.JavascriptBindings(bindToFrames=True, bindToPopups=True)
-        jsBindings.SetProperty("delay", int(command['delay']))
-        jsBindings.SetProperty("flash_delay", int(command['flash_delay']))
-        jsBindings.SetFunction("setPageSize", setPageSize)
-        jsBindings.SetFunction("jsCallback", jsCallback)
-        jsBindings.SetFunction("log", logging.info)
-        browser.SetJavascriptBindings(jsBindings)
-        #browser.WasResized()
-        cefpython.MessageLoop()
-        width = browser.GetUserData("width")
-        height = browser.GetUserData("height")
-        metadata = browser.GetUserData("metadata")
-        image = browser.GetUserData("image")
-        html = browser.GetUserData("html")
-
-    except:
-        logging.error(sys.exc_info())
-        traceback.print_exc()
-        metadata['error'] = str(sys.exc_info())
-    finally:
+    browser.SetUserData("done", False)
+    clientHandler = ClientHandler(browser, command)
+    browser.SetClientHandler(clientHandler)
+    jsBindings = cefpython.JavascriptBindings(bindToFrames=True, bindToPopups=True)
+    jsBindings.SetProperty("delay", int(command['delay']))
+    jsBindings.SetProperty("flash_delay", int(command['flash_delay']))
+    jsBindings.SetFunction("setPageSize", clientHandler.setPageSize)
+    jsBindings.SetFunction("jsCallback", clientHandler.jsCallback)
+    jsBindings.SetFunction("tileCallback", clientHandler.tileCallback)
+    jsBindings.SetFunction("log", logging.info)
+    browser.SetJavascriptBindings(jsBindings)
+    #browser.WasResized()
+    return browser, clientHandler
+
+
+def shutdown():
+    # Let CEF process the pending browser closes before shutting down
+    for i in range(10):
+        cefpython.MessageLoopWork()
+        sleep(MESSAGE_LOOP_INTERVAL)
+    cefpython.Shutdown()
+
+
+class Snapshot:
+    """A job in flight: the command, its browser and the collected outputs."""
+
+    def __init__(self, command, width=800, height=600, encoders=None, proxy=None):
+        self.command = command
+        self.encoders = encoders
+        self.proxy = proxy  # of the CEF instance
+        self.pendingShots = []
+        self.width = command.get('screen_width', width)
+        self.height = command.get('screen_height', height)
+        # timings are in seconds with sub-millisecond resolution
+        self.metadata = {'timestamp': int(time()), 'error': "0", 'timings': {}}
+        self.browser = None
+        self.clientHandler = None
+        self.started = time()
+        self.deadline = self.started + command.get('timeout', 60)
+        self.peakRss = 0  # of the process and its CEF subprocesses while in flight
+
+    def start(self):
+        if 'proxies' in self.command and self.proxy not in self.command['proxies']:
+            # Never fetch it directly or through a proxy it didn't ask for
+            self.metadata['error'] = "Proxy %s of the worker is not in the proxies of the command" % self.proxy
+            logging.error("Not snapshotting %s: %s" % (self.command['url'], self.metadata['error']))
+            return
+        try:
+            logging.info("Snapshot url: %s" % self.command['url'])
+            parent_dir = os.path.dirname(self.command['file'])
+            if parent_dir and not os.path.exists(parent_dir):
+                os.makedirs(parent_dir)
+            start = time()
+            self.browser, self.clientHandler = create_browser(self.command, self.width, self.height, self.metadata)
+            self.metadata['timings']['browser_create'] = round(time() - start, 4)
+            self.clientHandler.shotCallback = self.saveShot
+        except:
+            logging.error(sys.exc_info())
+            traceback.print_exc()
+            self.metadata['error'] = str(sys.exc_info())
+
+    def saveShot(self, number, image):
+        """Encode a shot before the last one to <file>_<number>.<format>, in
+        the background with an encoders pool."""
+        basename, ext = os.path.splitext(output_paths(self.command)['image'])
+        fpath = "%s_%d%s" % (basename, number, ext)
+        metadata = self.browser.GetUserData("metadata")
+        metadata.setdefault('shot_files', []).append(fpath)
+        args = (fpath, self.command, self.browser.GetUserData("width"), self.browser.GetUserData("height"), image)
+        if self.encoders:
+            self.pendingShots.append(self.encoders.apply_async(save_shot, args))
+        else:
+            save_shot(*args)
+
+    def done(self):
+        return self.browser is None or self.browser.GetUserData("done")
+
+    def expired(self):
+        return time() > self.deadline
+
+    def result(self):
+        """Close the browser and return (width, height, image, html, metadata)."""
+        width, height, image, html = self.width, self.height, None, None
+        metadata = self.metadata
+        browser = self.browser
+        if browser:
+            width = browser.GetUserData("width")
+            height = browser.GetUserData("height")
+            metadata = browser.GetUserData("metadata")
+            image = browser.GetUserData("image")
+            html = browser.GetUserData("html")
+            if not browser.GetUserData("done"):
+                metadata['error'] = "Timeout"
+                metadata['partial'] = 1
+            if image is None:
+                image = self.clientHandler.CaptureImage()
+            metadata['peak_rss'] = max(self.peakRss, sum(process_tree_rss()))
+            if 'shot_files' in metadata:
+                # The last shot is the main image
+                metadata['shot_files'].append(output_paths(self.command)['image'])
+            metadata['paints'] = self.clientHandler.paints
+            metadata['paint_bytes'] = self.clientHandler.paintBytes
+            browser.StopLoad()
+            browser.CloseBrowser(True)
+            self.browser = None
+        for pending in self.pendingShots:
+            try:
+                pending.get()
+            except:
+                logging.error(sys.exc_info())
+                metadata['error'] = "Failed saving shot: %s" % (sys.exc_info()[1],)
         if metadata['error'] == "0":
             metadata['status'] = "OK"
             metadata['finished'] = int(time())
         else:
             metadata['status'] = "error"
             metadata['time_finished'] = int(time())
-        cefpython.Shutdown()
+        metadata['latency'] = round(time() - self.started, 3)
+        return width, height, image, html, metadata
+
+    def partial(self):
+        """The outputs so far of a job whose message loop is stuck, without
+        calling into CEF."""
+        width, height, image, html = self.width, self.height, None, None
+        metadata = self.metadata
+        browser = self.browser
+        if browser:
+            # User data lives on the Python side of the browser object
+            width = browser.GetUserData("width")
+            height = browser.GetUserData("height")
+            metadata = browser.GetUserData("metadata")
+            image = browser.GetUserData("image")
+            html = browser.GetUserData("html")
+            if image is None:
+                image = self.clientHandler.CaptureImage()
+        metadata.update(timeout_metadata())
+        metadata['partial'] = 1
+        metadata['peak_rss'] = self.peakRss
+        metadata['latency'] = round(time() - self.started, 3)
         return width, height, image, html, metadata
 
 
-def get_elements(url, xhtml, tag):
-    url = url.rstrip('/')
-    elements = xhtml.xpath("//" + tag)
+def run_snapshots(commands, concurrency=1, encoders=None, active=None, proxy=None):
+    """Snapshot the commands with up to |concurrency| browsers in flight.
+
+    CEF must already be initialized. Yields (command, (width, height, image,
+    html, metadata)) as each job completes. |commands| may yield None when no
+    command is available yet, the message loop keeps running meanwhile.
+    The shots before the last of multi-shot commands are saved as they are
+    taken, on the |encoders| pool if given. The jobs in flight are kept in
+    the |active| list when given, for a watchdog. Commands with proxies
+    fail unless the |proxy| CEF was initialized with is one of them.
+    """
+    commands = iter(commands)
+    active = [] if active is None else active
+    exhausted = False
+    sampled = 0
+    while active or not exhausted:
+        while not exhausted and len(active) < concurrency:
+            try:
+                command = next(commands)
+            except StopIteration:
+                exhausted = True
+                break
+            if command is None:
+                break
+            snapshot = Snapshot(command, encoders=encoders, proxy=proxy)
+            snapshot.start()
+            active.append(snapshot)
+        # Pump the CEF message loop ourselves instead of cefpython.MessageLoop()
+        # so that CEF survives across jobs and timeouts are enforced here.
+        cefpython.MessageLoopWork()
+        if active and time() - sampled >= MEMORY_SAMPLE_INTERVAL:
+            sampled = time()
+            rss = sum(process_tree_rss())
+            for snapshot in active:
+                snapshot.peakRss = max(snapshot.peakRss, rss)
+        for snapshot in list(active):
+            if snapshot.clientHandler:
+                snapshot.clientHandler.Poll()
+            if snapshot.done() or snapshot.expired():
+                result = snapshot.result()  # still watched while it closes the browser
+                active.remove(snapshot)
+                yield snapshot.command, result
+        sleep(MESSAGE_LOOP_INTERVAL)
+
+
+def snap(command, width=800, height=600, proxy=None, active=None):
+    timings = {}
+    try:
+        if not proxy and 'proxies' in command:
+            proxy = command['proxies'][0]
+        start = time()
+        initialize(proxy)
+        timings['cef_init'] = round(time() - start, 4)
+        # Encode earlier shots while waiting for the next
+        encoders = EncoderPool(1) if command.get('shots', 1) > 1 else None
+        for command, result in run_snapshots([command], encoders=encoders, active=active, proxy=proxy):
+            break
+        if encoders:
+            encoders.close()
+    finally:
+        start = time()
+        shutdown()
+        timings['shutdown'] = round(time() - start, 4)
+    result[4]['timings'].update(timings)
+    return result
+
+
+def timeout_metadata(error="Timeout"):
+    return {'timestamp': int(time()), 'status': "error", 'time_finished': int(time()), 'error': error}
+
 
-    def get_src(element):
-        if 'src' in element.attrib:
-            path = element.get('src')
-            if path.startswith("http"):
-                return path
+def kill_process_group(pgid):
+    """Kill a snapshot process along with the CEF renderer and GPU
+    subprocesses of its group."""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass  # already gone
+
+
+def kill_process_tree():
+    """Kill the CEF subprocesses of this process, then the process. Unlike
+    kill_process_group() it spares the other processes of the shell job."""
+    for pid in process_descendants(os.getpid()):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class LoopWatchdog(threading.Thread):
+    """Guards a long running run_snapshots() loop: the loop enforces the
+    job deadlines itself, a job WATCHDOG_GRACE seconds past its deadline
+    means CEF is stuck. The partial outputs of the jobs in flight are then
+    saved, |finished| is called with their commands, and the worker is
+    killed along with its CEF subprocesses."""
+
+    def __init__(self, active, finished=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.active = active
+        self.finished = finished
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            sleep(1)
+            snapshots = list(self.active)
+            if snapshots and time() > min(snapshot.deadline for snapshot in snapshots) + WATCHDOG_GRACE:
+                break
+        else:
+            return
+        logging.error("Message loop stuck %ds past a job timeout, killing the worker" % WATCHDOG_GRACE)
+        for snapshot in snapshots:
+            try:
+                save_results(snapshot.command, *snapshot.partial())
+                if self.finished:
+                    self.finished(snapshot.command)
+            except:
+                logging.error(sys.exc_info())
+        if event_log:
+            event_log.emit("worker_killed", jobs_in_flight=len(snapshots))
+        kill_process_tree()
+
+
+def _snap_child(connection, command, proxy, attempts=None, final=True):
+    # Lead a process group so that the CEF subprocesses can be killed with us
+    os.setpgrp()
+    lock = threading.Lock()
+    active = []
+    start = time()
+
+    def send(result):
+        # The image is encoded and saved here, only the status crosses the pipe
+        with lock:
+            if connection.closed:
+                return
+            metadata = result[4]
+            if attempts is not None:
+                attempt_metadata(metadata, proxy, attempts, time() - start)
+            if final or not proxy_failed(metadata):
+                connection.send((metadata, save_results(command, *result)))
             else:
-                path = path.lstrip('/')
-                return url + '/' + path
+                connection.send((metadata, None))  # the next proxy gets a try
+            connection.close()
+
+    def watchdog():
+        # snap() enforces the timeout between two message loop iterations, we
+        # only get here when CEF itself is stuck: save the partial results
+        logging.error("Snapshot stuck %ds past its timeout, killing it" % WATCHDOG_GRACE)
+        for snapshot in list(active):
+            send(snapshot.partial())
+        send((None, None, None, None, timeout_metadata()))
+        kill_process_group(os.getpgrp())
+
+    timer = threading.Timer(command.get('timeout', 60) + WATCHDOG_GRACE, watchdog)
+    timer.daemon = True
+    timer.start()
+    try:
+        result = snap(command, proxy=proxy, active=active)
+        timer.cancel()
+        send(result)
+    finally:
+        timer.cancel()
+        with lock:
+            connection.close()
+
+
+def attempt_metadata(metadata, proxy, attempts, latency):
+    """Record the proxy of a failover attempt and the attempts so far in its
+    metadata."""
+    metadata['proxy'] = proxy
+    metadata['proxy_attempts'] = attempts + [
+        {'proxy': proxy, 'error': metadata['error'], 'latency': round(latency, 3)}]
+    return metadata
+
+
+def snap_process(command, proxy=None, attempts=None, final=True):
+    """Run snap() in a child process, CEF can only be initialized once per
+    process. The child saves the results, (metadata, error) is returned. The
+    process and its CEF subprocesses are killed if they outlive the timeout
+    of the command.
+
+    |attempts| lists the previous proxies of a failover, whose metadata
+    goes with the results. A failed attempt isn't saved unless |final|."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_snap_child, args=(sender, command, proxy, attempts, final))
+    start = time()
+    process.start()
+    sender.close()
+    result = None
+    try:
+        try:
+            # The child has a watchdog of its own, this is a guard against it failing too
+            if receiver.poll(command.get('timeout', 60) + 2 * WATCHDOG_GRACE):
+                result = receiver.recv()
+        except EOFError:
+            pass
+        if result is None:
+            metadata = timeout_metadata("Timeout" if process.is_alive() else "Snapshot process died")
         else:
-            return url
-    elements = map(get_src, elements)
-    elements = list(OrderedDict.fromkeys(elements))  # remove duplicates
-    return elements
+            process.join(WATCHDOG_GRACE)
+        if process.is_alive():
+            logging.error("Killing snapshot process %d" % process.pid)
+    finally:
+        # Also reaps the subprocesses left behind by a crashed browser
+        # process, or by an interrupt of the parent
+        kill_process_group(process.pid)
+        process.join()
+    if result is None:
+        if attempts is not None:
+            attempt_metadata(metadata, proxy, attempts, time() - start)
+        error = None
+        if final or not proxy_failed(metadata):
+            error = save_results(command, None, None, None, None, metadata)
+        result = (metadata, error)
+    return result
+
+
+def snap_with_failover(command, proxyPool):
+    """Snapshot through the proxies of the command in the order of the pool,
+    until one of them loads the page. The timeout applies to each attempt.
+    Return whether saving the results failed."""
+    attempts = []
+    proxies = proxyPool.order(command['proxies'])
+    for i, proxy in enumerate(proxies):
+        logging.info("Trying proxy %s" % proxy)
+        start = time()
+        metadata, error = snap_process(command, proxy, attempts, i == len(proxies) - 1)
+        latency = time() - start
+        failed = proxy_failed(metadata)
+        proxyPool.record(proxy, not failed, latency)
+        attempts.append({'proxy': proxy, 'error': metadata['error'], 'latency': round(latency, 3)})
+        if not failed:
+            break
+        logging.error("Proxy %s failed: %s" % (proxy, metadata['error']))
+    return error
+
+
+# Every element get_assets() looks at, matched in one walk of the tree
+ASSETS_XPATH = lxml.etree.XPath(
+    "//*[self::base or self::img or self::source or self::video or self::audio or self::script"
+    " or self::link or self::embed or self::object or self::applet or self::iframe or self::style"
+    " or @style]")
+CSS_URL_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)|@import\s+['"]([^'"]+)['"]""")
+
+
+def get_assets(url, html):
+    """Return the URLs of the assets of the page by kind, resolved against
+    the page URL or its <base href>, in document order without duplicates."""
+    xhtml = lxml.html.document_fromstring(html)
+    kinds = ('images', 'media', 'scripts', 'stylesheets', 'embeds', 'applets', 'iframes', 'links', 'css_urls')
+    assets = dict((kind, []) for kind in kinds)
+    base = None
+
+    def srcset(value):
+        return [candidate.split()[0] for candidate in value.split(',') if candidate.strip()]
+    for element in ASSETS_XPATH(xhtml):
+        tag = element.tag
+        get = element.get
+        if tag == 'base':
+            base = base or get('href')
+        elif tag == 'img':
+            assets['images'].extend([get('src')] + srcset(get('srcset') or ""))
+        elif tag == 'source':
+            # Image candidates of a <picture>, files of a <video>/<audio>
+            parent = element.getparent()
+            if parent is not None and parent.tag == 'picture':
+                assets['images'].extend(srcset(get('srcset') or "") or [get('src')])
+            else:
+                assets['media'].append(get('src'))
+        elif tag in ('video', 'audio'):
+            assets['media'].append(get('src'))
+            assets['images'].append(get('poster'))
+        elif tag == 'script':
+            assets['scripts'].append(get('src'))
+        elif tag == 'link':
+            rel = (get('rel') or "").lower().split()
+            assets['stylesheets' if 'stylesheet' in rel else 'links'].append(get('href'))
+        elif tag == 'embed':
+            assets['embeds'].append(get('src'))
+        elif tag == 'object':
+            assets['embeds'].append(get('data'))
+        elif tag == 'applet':
+            assets['applets'].append(get('src') or get('code') or get('archive'))
+        elif tag == 'iframe':
+            assets['iframes'].append(get('src'))
+        elif tag == 'style' and element.text:
+            assets['css_urls'].extend(a or b for a, b in CSS_URL_RE.findall(element.text))
+        if get('style'):
+            assets['css_urls'].extend(a or b for a, b in CSS_URL_RE.findall(get('style')))
+    base = urlparse.urljoin(url, base.strip()) if base else url
+    for kind in kinds:
+        urls = (urlparse.urljoin(base, path.strip()) for path in assets[kind]
+                if path and not path.strip().lower().startswith(('data:', 'javascript:', '#')))
+        assets[kind] = list(OrderedDict.fromkeys(urls))  # remove duplicates
+    return assets
 
 
 def load_command(fpath):
     with open(fpath) as f:
-        command = json.load(f)
-        command = dict((k, v) for k, v in command.iteritems() if v)  # remove keys with empty values
+        return parse_command(json.load(f))
+
+
+def parse_command(command):
+    command = dict((k, v) for k, v in command.iteritems() if v)  # remove keys with empty values
     types = {'action': str,
              'cookie': str,
              'delay': int,
@@ -480,10 +1842,18 @@ def load_command(fpath):
              'file': str,
              'flash_delay': int,
              'delay': int,
+             'format': str,
+             'compression': int,
+             'quality': int,
+             'drop_alpha': int,
              'headers': str,
              'height': int,
              'id': int,
+             'idle_time': int,
              'instance_id': int,
+             'phash_distance': int,
+             'previous_hash': str,
+             'previous_phash': str,
              'priority': int,
              'real_id': int,
              'referer': str,
@@ -493,7 +1863,10 @@ def load_command(fpath):
              'size': str,
              'shot_interval': int,
              'shots': int,
+             'stream': int,
+             'tile_height': int,
              'timeout': int,
+             'timings': int,
              'url': str,
              'useragent': str,
              'virtual_id': int,
@@ -511,65 +1884,750 @@ def load_command(fpath):
     if 'proxies' in command:
         if type(command['proxies']) != list:
             raise Exception("proxies must be a list in command json")
+    if 'thumbnails' in command:
+        # list of [width, height] or "<width>x<height>" strings
+        command['thumbnails'] = [tuple(int(x) for x in (size.split('x') if isinstance(size, basestring) else size))
+                                 for size in command['thumbnails']]
+    if 'thumbalizr' in command and 'width' in command and 'height' in command:
+        command['thumbnails'] = command.get('thumbnails', []) + [(command['width'], command['height'])]
+    if 'format' in command:
+        command['format'] = command['format'].lower()
+        if command['format'] not in IMAGE_FORMATS:
+            raise Exception("format must be one of %s in command json" % ", ".join(sorted(IMAGE_FORMATS)))
 
     return command
 
 
+def is_batch(fpath):
+    """A batch file holds a JSON array or several JSON Lines of commands."""
+    with open(fpath) as f:
+        first_line = f.readline()
+        if first_line.lstrip().startswith('['):
+            return True
+        try:
+            json.loads(first_line)
+        except ValueError:
+            return False  # a single command spread over several lines
+        return any(line.strip() for line in f)
+
+
+def load_commands(f):
+    """Yield the commands of a batch, a JSON array or JSON Lines.
+
+    The batch is read by a thread so that it can be fed from a pipe without
+    blocking the message loop, None is yielded while no command is
+    available yet. Invalid entries are logged and skipped.
+    """
+    entries = Queue.Queue()
+    end = object()
+
+    def read():
+        try:
+            # readline(), file iteration reads ahead and would hold lines back
+            first_line = f.readline()
+            if first_line.lstrip().startswith('['):
+                for entry in json.loads(first_line + f.read()):
+                    entries.put(entry)
+            else:
+                for line in itertools.chain([first_line], iter(f.readline, '')):
+                    if line.strip():
+                        entries.put(line)
+        except:
+            logging.error("Failed reading batch: %s" % sys.exc_info()[1])
+        finally:
+            entries.put(end)
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    while True:
+        try:
+            entry = entries.get_nowait()
+        except Queue.Empty:
+            yield None
+            continue
+        if entry is end:
+            return
+        try:
+            if not isinstance(entry, dict):
+                entry = json.loads(entry)
+            command = parse_command(entry)
+        except:
+            logging.error("Invalid command in batch: %s" % sys.exc_info()[1])
+            continue
+        yield command
+
+
+def output_paths(command):
+    basename = os.path.splitext(command['file'])[0]
+    image_format = command.get('format', "png")
+    return {'image': basename + IMAGE_FORMATS[image_format][0],
+            'html': basename + ".html",
+            'metadata': basename + ".finished"}
+
+
+def image_options(command):
+    """The save_image() arguments after the image size for a command."""
+    return (command.get('format', "png"), command.get('compression'),
+            command.get('quality'), command.get('drop_alpha'))
+
+
+def save_shot(fpath, command, width, height, image):
+    logging.info("Saving shot (%dx%d): %s" % (width, height, fpath))
+    save_image(fpath, image, width, height, *image_options(command))
+
+
+class EncoderPool:
+    """Threads encoding the images while the next pages render.
+
+    At most |backlog| encodings are queued or running, apply_async() blocks
+    beyond that so that screenshots don't pile up in memory when the
+    browsers render faster than the images are encoded.
+    """
+
+    def __init__(self, processes, backlog=None):
+        self._pool = multiprocessing.pool.ThreadPool(processes=processes)
+        self._slots = threading.Semaphore(backlog or 2 * processes)
+
+    def apply_async(self, func, args=()):
+        self._slots.acquire()
+
+        def run(*args):
+            try:
+                return func(*args)
+            finally:
+                self._slots.release()
+        return self._pool.apply_async(run, args)
+
+    def close(self):
+        self._pool.close()
+
+    def join(self):
+        self._pool.join()
+
+
+def save_results(command, width, height, image, html, metadata, encoders=None, pending=None, finished=None):
+    """Write the .html/.png/.finished outputs of a job, return True on error.
+
+    With an |encoders| pool the image is encoded in the background and the
+    .finished file is written once the image is in place. The AsyncResult
+    of the encoding, True if it failed, is then added to the |pending| list
+    when given. |finished| is called once the outputs are written.
+    """
+    fpath = output_paths(command)
+    error = metadata['error'] != "0"
+    if error:
+        logging.error(metadata['error'])
+    if html:
+        if 'details' in command and command['details'] == 3:
+            start = time()
+            url = metadata['final_url']
+            metadata.update(get_assets(url, html))
+            metadata['timings']['assets'] = round(time() - start, 4)
+        logging.info("Saving html: %s" % fpath['html'])
+        if 'html' in command and command['html'] == 1:
+            if output_store:
+                metadata['html_hash'], metadata['html_file'] = output_store.save_html(html)
+            else:
+                save_html(fpath['html'], html)
+    # The screenshot of a job that timed out is kept as a partial result
+    if not image or (error and not metadata.get('partial')):
+        save_metadata(fpath['metadata'], command, metadata)
+        if finished:
+            finished()
+        return error
+    args = (fpath, command, width, height, image, metadata, finished)
+    if encoders:
+        result = encoders.apply_async(save_snapshot, args)
+        if pending is not None and not error:
+            pending.append(result)
+        return error
+    return save_snapshot(*args) or error
+
+
+def save_metadata(fpath, command, metadata):
+    if metadata:
+        command.update(metadata)
+        if output_store:
+            logging.info("Archiving metadata of %s" % command['file'])
+            output_store.append(command)
+        else:
+            logging.info("Saving metadata: %s" % fpath)
+            save_json(fpath, command)
+
+
+def save_snapshot(fpath, command, width, height, image, metadata, finished=None):
+    """Encode the screenshot and its thumbnails then write the .finished
+    file, return True when the image could not be saved. |finished| is
+    called in the end, failed or not."""
+    try:
+        return _save_snapshot(fpath, command, width, height, image, metadata)
+    finally:
+        if finished:
+            finished()
+
+
+def _save_snapshot(fpath, command, width, height, image, metadata):
+    options = image_options(command)
+    try:
+        start = time()
+        image = as_image(image, width, height)
+        metadata['image_hash'], metadata['image_phash'] = image_hashes(image)
+        metadata['timings']['hash'] = round(time() - start, 4)
+        if image_unchanged(command, metadata):
+            logging.info("Snapshot unchanged since the previous run, not saving: %s" % fpath['image'])
+            metadata['unchanged'] = 1
+            save_metadata(fpath['metadata'], command, metadata)
+            return False
+        logging.info("Saving snapshot (%dx%d): %s" % (width, height, fpath['image']))
+        start = time()
+        save_image(fpath['image'], image, width, height, *options)
+        metadata['timings']['encode'] = round(time() - start, 4)
+        if 'thumbnails' in command:
+            start = time()
+            basename, ext = os.path.splitext(fpath['image'])
+            metadata['thumbnails'] = []
+            # Thumbnails come from the in-memory screenshot, not the saved file
+            for w, h, thumbnail in make_thumbnails(image, command['thumbnails']):
+                thumbnail_fpath = "%s_%dx%d%s" % (basename, w, h, ext)
+                logging.info("Saving thumbnail (%dx%d): %s" % (w, h, thumbnail_fpath))
+                save_image(thumbnail_fpath, thumbnail, w, h, *options)
+                metadata['thumbnails'].append(thumbnail_fpath)
+            metadata['timings']['thumbnails'] = round(time() - start, 4)
+    except:
+        logging.error(sys.exc_info())
+        traceback.print_exc()
+        metadata['status'] = "error"
+        metadata['error'] = "Failed saving image: %s" % (sys.exc_info()[1],)
+        save_metadata(fpath['metadata'], command, metadata)
+        return True
+    save_metadata(fpath['metadata'], command, metadata)
+    return False
+
+
+def process_descendants(pid):
+    """Pids of the children of the process, of their children..., read
+    from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    descendants = []
+    pending = list(children.get(pid, []))
+    while pending:
+        child = pending.pop()
+        descendants.append(child)
+        pending.extend(children.get(child, []))
+    return descendants
+
+
+def process_tree_rss(pid=None):
+    """RSS in bytes of the process and of all its descendants (the CEF
+    renderer, GPU... subprocesses)."""
+    pid = pid or os.getpid()
+
+    def rss(pid):
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                return int(f.read().split()[1]) * PAGE_SIZE
+        except (IOError, IndexError, ValueError):
+            return 0
+    return rss(pid), sum(rss(child) for child in process_descendants(pid))
+
+
+def error_class(metadata):
+    error = metadata.get('error', "0")
+    if error == "0":
+        return "ok"
+    if error == "Timeout":
+        return "timeout"
+    if 'error_code' in metadata:
+        return "load_error"
+    if error.startswith("Failed loading page got status code"):
+        return "http_status"
+    return "other"
+
+
+class Metrics:
+    """Job counters and latency histogram of a worker, served in the
+    Prometheus text format."""
+
+    LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time()
+        self.jobs = {}  # error class -> count
+        self.latencyBuckets = [0] * len(self.LATENCY_BUCKETS)
+        self.latencySum = 0.0
+        self.latencyCount = 0
+        self.bytesDownloaded = 0
+
+    def job_done(self, metadata):
+        with self._lock:
+            errorClass = error_class(metadata)
+            self.jobs[errorClass] = self.jobs.get(errorClass, 0) + 1
+            latency = metadata.get('latency', 0)
+            for i, bucket in enumerate(self.LATENCY_BUCKETS):
+                if latency <= bucket:
+                    self.latencyBuckets[i] += 1
+            self.latencySum += latency
+            self.latencyCount += 1
+            self.bytesDownloaded += metadata.get('bytes_downloaded', 0)
+
+    def render(self):
+        rss, childrenRss = process_tree_rss()
+        with self._lock:
+            lines = ["# TYPE pycefsnap_jobs_total counter"]
+            for errorClass, count in sorted(self.jobs.items()):
+                lines.append('pycefsnap_jobs_total{result="%s"} %d' % (errorClass, count))
+            lines.append("# TYPE pycefsnap_job_latency_seconds histogram")
+            for bucket, count in zip(self.LATENCY_BUCKETS, self.latencyBuckets):
+                lines.append('pycefsnap_job_latency_seconds_bucket{le="%s"} %d' % (bucket, count))
+            lines.append('pycefsnap_job_latency_seconds_bucket{le="+Inf"} %d' % self.latencyCount)
+            lines.append("pycefsnap_job_latency_seconds_sum %.3f" % self.latencySum)
+            lines.append("pycefsnap_job_latency_seconds_count %d" % self.latencyCount)
+            lines.append("# TYPE pycefsnap_downloaded_bytes_total counter")
+            lines.append("pycefsnap_downloaded_bytes_total %d" % self.bytesDownloaded)
+        lines.append("# TYPE pycefsnap_uptime_seconds gauge")
+        lines.append("pycefsnap_uptime_seconds %.3f" % (time() - self.started))
+        lines.append("# TYPE pycefsnap_rss_bytes gauge")
+        lines.append('pycefsnap_rss_bytes{process="python"} %d' % rss)
+        lines.append('pycefsnap_rss_bytes{process="cef_subprocesses"} %d' % childrenRss)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def start_metrics_server(address, port):
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving metrics on http://%s:%d/metrics" % (address, port))
+    return server
+
+
+class EventLog:
+    """Structured log of the worker, one JSON object per line."""
+
+    def __init__(self, fpath):
+        self._lock = threading.Lock()
+        self._file = open(fpath, 'a')
+        # Not inherited when a recycled worker re-executes itself
+        fcntl.fcntl(self._file, fcntl.F_SETFD, fcntl.fcntl(self._file, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = round(time(), 3)
+        fields['pid'] = os.getpid()
+        line = json.dumps(fields)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Set by main() when --metrics-port and --event-log are given
+metrics = None
+event_log = None
+
+
+def job_finished(command, metadata):
+    if metrics:
+        metrics.job_done(metadata)
+    if event_log:
+        event_log.emit("job_finished",
+                       id=command.get('id'),
+                       url=command.get('url'),
+                       file=command.get('file'),
+                       result=error_class(metadata),
+                       error=metadata.get('error'),
+                       latency=metadata.get('latency'),
+                       timings=metadata.get('timings'),
+                       requests=metadata.get('requests', 0),
+                       bytes_downloaded=metadata.get('bytes_downloaded', 0))
+
+
+_stopping = False
+_recycling = False
+
+
+def _stop(signum, frame):
+    global _stopping
+    logging.info("Got signal %d, stopping after current job" % signum)
+    _stopping = True
+
+
+class SpoolScheduler:
+    """Picks the next command file (*.json) of a spool directory to snapshot.
+
+    Higher priority commands go first. Within a priority the instance_id
+    with the fewest jobs in flight goes first, so that a bulk crawl doesn't
+    starve the other instances, then the oldest file. A command waits while
+    its domain has |domain_limit| jobs in flight or had one started less
+    than |domain_delay| seconds ago.
+
+    Commands are claimed by renaming them to *.json.working, the claimed
+    files are the jobs in flight of all the workers sharing the spool. A
+    claimed file older than the timeout of its job and twice WATCHDOG_GRACE
+    is an orphan, its job is no longer counted. The last start of each
+    domain is the mtime of a marker file in the .domain-starts directory of
+    the spool, it outlives the job.
+    """
+
+    def __init__(self, spool, domain_limit=2, domain_delay=0):
+        self.spool = spool
+        self.domain_limit = domain_limit
+        self.domain_delay = domain_delay
+        self._commands = {}  # file name -> (mtime, domain, command), None if invalid
+        self._served = {}  # instance_id -> time this worker last claimed one of its commands
+        self._starts = os.path.join(spool, ".domain-starts")
+        if domain_delay and not os.path.exists(self._starts):
+            try:
+                os.mkdir(self._starts)
+            except OSError:
+                pass  # created by another worker
+
+    def _marker(self, domain):
+        return os.path.join(self._starts, hashlib.sha1(domain or "").hexdigest())
+
+    def _load(self, fname, fpath):
+        try:
+            mtime = os.stat(fpath).st_mtime
+        except OSError:
+            return None  # claimed or finished meanwhile
+        cached = self._commands.get(fname)
+        if cached is None or cached[0] != mtime:
+            try:
+                command = load_command(fpath)
+                cached = (mtime, urlparse.urlparse(command['url']).hostname, command)
+            except:
+                logging.error("Invalid command file %s: %s" % (fpath, sys.exc_info()[1]))
+                if fpath.endswith('.json'):
+                    os.rename(fpath, fpath + '.failed')
+                return None
+            self._commands[fname] = cached
+        return cached
+
+    def claim(self):
+        """Claim the next command, return (claimed file path, command) or
+        None when no command can be started now."""
+        pending = []
+        in_flight = {}  # domain -> [jobs, time of the last start]
+        instances = {}  # instance_id -> jobs in flight
+        fnames = set()
+        for fname in os.listdir(self.spool):
+            if fname.endswith('.json.working'):
+                fname = fname[:-len('.working')]
+                fpath = os.path.join(self.spool, fname + '.working')
+                entry = self._load(fname, fpath)
+                if entry:
+                    mtime, domain, command = entry
+                    try:
+                        started = os.stat(fpath).st_ctime  # the rename that claimed it
+                    except OSError:
+                        continue
+                    if time() - started > command.get('timeout', 60) + 2 * WATCHDOG_GRACE:
+                        continue  # left behind by a worker that was killed
+                    jobs = in_flight.setdefault(domain, [0, 0])
+                    jobs[0] += 1
+                    jobs[1] = max(jobs[1], started)
+                    instance = command.get('instance_id')
+                    instances[instance] = instances.get(instance, 0) + 1
+            elif fname.endswith('.json'):
+                entry = self._load(fname, os.path.join(self.spool, fname))
+                if entry:
+                    pending.append((fname,) + entry)
+            else:
+                continue
+            fnames.add(fname)
+        for fname in set(self._commands) - fnames:
+            del self._commands[fname]
+        now = time()
+        candidates = []
+        for fname, mtime, domain, command in pending:
+            jobs, started = in_flight.get(domain, (0, 0))
+            if jobs >= self.domain_limit or now - started < self.domain_delay:
+                continue
+            instance = command.get('instance_id')
+            candidates.append(((-command.get('priority', 0), instances.get(instance, 0),
+                                self._served.get(instance, 0), mtime), fname, domain, command))
+        if not candidates:
+            return None
+        if not self.domain_delay:
+            return self._claim(sorted(candidates))
+        # The workers check and record the domain starts one at a time
+        with open(os.path.join(self._starts, ".lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._claim(sorted(candidates))
+
+    def _claim(self, candidates):
+        for key, fname, domain, command in candidates:
+            if self.domain_delay:
+                marker = self._marker(domain)
+                try:
+                    if time() - os.stat(marker).st_mtime < self.domain_delay:
+                        continue
+                except OSError:
+                    pass  # never started
+            fpath = os.path.join(self.spool, fname)
+            try:
+                os.rename(fpath, fpath + '.working')
+            except OSError:
+                continue  # taken by another worker
+            if self.domain_delay:
+                with open(marker, 'a'):
+                    pass
+                os.utime(marker, None)
+            self._served[command.get('instance_id')] = time()
+            return fpath + '.working', dict(command)
+        return None
+
+
+def spool_commands(scheduler, claimed, poll_interval=1.0):
+    """Yield the commands picked by the SpoolScheduler until stopped.
+
+    Yields None while no command can be started. The claimed file of each
+    command is recorded in |claimed|, keyed by id(command).
+    """
+    last_poll = 0
+    while not _stopping and not _recycling:
+        if time() - last_poll < poll_interval:
+            yield None
+            continue
+        claim = scheduler.claim()
+        if not claim:
+            last_poll = time()
+            yield None
+            continue
+        fpath, command = claim
+        claimed[id(command)] = fpath
+        yield command
+
+
+def record_proxy(proxyPool, proxy, metadata):
+    if proxy:
+        metadata['proxy'] = proxy
+        proxyPool.record(proxy, not proxy_failed(metadata), metadata['latency'])
+
+
+def serve(spool, proxy=None, poll_interval=1.0, concurrency=1, encoders=2, proxyPool=None,
+          domain_limit=2, domain_delay=0, max_jobs=None, max_rss=None):
+    """Long running worker: initialize CEF once and process every command
+    file dropped in the spool directory.
+
+    Returns True when the worker stopped to be recycled, after |max_jobs|
+    jobs or when the RSS of the process and its CEF subprocesses went over
+    |max_rss| bytes between two jobs.
+    """
+    global _stopping, _recycling
+    _stopping = _recycling = False
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    start = time()
+    encoders = EncoderPool(encoders)
+    initialize(proxy)
+    logging.info("CEF initialized in %.3fs, watching spool %s with %d browser(s)"
+                 % (time() - start, spool, concurrency))
+    if event_log:
+        event_log.emit("worker_started", spool=spool, proxy=proxy, concurrency=concurrency,
+                       cef_init=round(time() - start, 4))
+    jobs = 0
+    total_latency = 0.0
+    scheduler = SpoolScheduler(spool, domain_limit, domain_delay)
+    claimed = {}
+    active = []
+    watchdog = LoopWatchdog(active, lambda command: os.remove(claimed.pop(id(command))))
+    watchdog.start()
+    try:
+        for command, result in run_snapshots(spool_commands(scheduler, claimed, poll_interval), concurrency, encoders,
+                                             active, proxy):
+            width, height, image, html, metadata = result
+            jobs += 1
+            total_latency += metadata['latency']
+            metadata['worker_jobs'] = jobs
+            record_proxy(proxyPool, proxy, metadata)
+            # The claim is released once the outputs are written, a worker
+            # killed before that leaves the job in the spool
+            release = lambda command=command: os.remove(claimed.pop(id(command)))
+            try:
+                save_results(command, width, height, image, html, metadata, encoders, finished=release)
+            except:
+                logging.error(sys.exc_info())
+                traceback.print_exc()
+                if id(command) in claimed:
+                    release()
+            job_finished(command, metadata)
+            logging.info("Job %d done in %.3fs (avg %.3fs, cumulative %.3fs, uptime %.3fs)"
+                         % (jobs, metadata['latency'], total_latency / jobs, total_latency, time() - start))
+            rss = sum(process_tree_rss())
+            if not _recycling and ((max_jobs and jobs >= max_jobs) or (max_rss and rss > max_rss)):
+                # Finish the jobs in flight and leave
+                logging.info("Recycling worker after %d jobs at %dMB RSS" % (jobs, rss // (1024 * 1024)))
+                _recycling = True
+    finally:
+        watchdog.stopped = True
+        shutdown()
+        encoders.close()
+        encoders.join()
+        if event_log:
+            event_log.emit("worker_stopped", jobs=jobs, uptime=round(time() - start, 3),
+                           recycle=_recycling and not _stopping)
+    return _recycling and not _stopping
+
+
+def recycle_worker(metrics_server=None):
+    """Replace the worker process with a fresh one with the same arguments,
+    CEF and its subprocesses start over."""
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server.server_close()  # not inherited by the new process
+    if event_log:
+        event_log.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def batch(commands, proxy=None, concurrency=1, encoders=2, proxyPool=None):
+    """Snapshot every command of a batch with one CEF instance, the outputs
+    of each job are written as soon as it completes. Returns the number of
+    failed jobs."""
+    encoders = EncoderPool(encoders)
+    initialize(proxy)
+    jobs = 0
+    errors = 0
+    pending = []  # encodings in the background
+    active = []
+    watchdog = LoopWatchdog(active)
+    watchdog.start()
+
+    def failed(encoding):
+        try:
+            return encoding.get()
+        except:
+            logging.error(sys.exc_info())
+            return True
+    try:
+        for command, result in run_snapshots(commands, concurrency, encoders, active, proxy):
+            width, height, image, html, metadata = result
+            jobs += 1
+            record_proxy(proxyPool, proxy, metadata)
+            for encoding in [encoding for encoding in pending if encoding.ready()]:
+                pending.remove(encoding)
+                errors += failed(encoding)
+            try:
+                if save_results(command, width, height, image, html, metadata, encoders, pending):
+                    errors += 1
+            except:
+                errors += 1
+                logging.error(sys.exc_info())
+                traceback.print_exc()
+            job_finished(command, metadata)
+            logging.info("Job %d done in %.3fs" % (jobs, metadata['latency']))
+    finally:
+        watchdog.stopped = True
+        shutdown()
+        encoders.close()
+        encoders.join()
+    errors += sum(failed(encoding) for encoding in pending)
+    logging.info("Batch done: %d jobs, %d errors" % (jobs, errors))
+    return errors
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('input', nargs='?')
+    parser.add_argument('--spool')
+    parser.add_argument('--proxy')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--encoders', type=int, default=2)
+    parser.add_argument('--domain-limit', type=int, default=2)
+    parser.add_argument('--domain-delay', type=float, default=0)
+    parser.add_argument('--max-jobs', type=int)
+    parser.add_argument('--max-rss', type=int)
+    parser.add_argument('--cache')
+    parser.add_argument('--cache-size', type=int, default=512)
+    parser.add_argument('--store')
+    parser.add_argument('--store-compression', choices=sorted(OutputStore.EXTENSIONS), default="gzip")
+    parser.add_argument('--metrics-port', type=int)
+    parser.add_argument('--metrics-address', default="127.0.0.1")
+    parser.add_argument('--event-log')
+    parser.add_argument('--proxy-state', default=os.path.join(tempfile.gettempdir(), "pycefsnap-proxies.json"))
+    parser.add_argument('-h', '--help', action='store_true')
+    return parser.parse_args(argv)
+
+
 def main():
-    if len(sys.argv) < 2:
+    global resource_cache, output_store, metrics, event_log
+    args = parse_args(sys.argv[1:])
+    metrics_server = None
+    if args.help or not (args.input or args.spool):
         print_usage()
         sys.exit(0)
-    command = load_command(os.path.abspath(sys.argv[1]))
-    pool = multiprocessing.pool.ThreadPool(processes=1)
-    metadata = dict()
-    html = None
-    image = None
-    async_result = pool.apply_async(snap, (command,))
+    if args.cache:
+        resource_cache = ResourceCache(os.path.abspath(args.cache), args.cache_size * 1024 * 1024)
+    if args.store:
+        output_store = OutputStore(os.path.abspath(args.store), args.store_compression)
+    if args.metrics_port:
+        metrics = Metrics()
+        metrics_server = start_metrics_server(args.metrics_address, args.metrics_port)
+    if args.event_log:
+        event_log = EventLog(os.path.abspath(args.event_log))
+    proxyPool = ProxyPool(args.proxy_state)
+    # A worker or batch keeps one proxy for its CEF instance, the healthiest
+    # of the list in rotation
+    proxy = proxyPool.order(args.proxy.split(','))[0] if args.proxy else None
+    if args.spool:
+        max_rss = args.max_rss * 1024 * 1024 if args.max_rss else None
+        if serve(os.path.abspath(args.spool), proxy, args.poll_interval, args.concurrency, args.encoders, proxyPool,
+                 args.domain_limit, args.domain_delay, args.max_jobs, max_rss):
+            recycle_worker(metrics_server)
+        sys.exit(0)
+    if args.input == '-':
+        errors = batch(load_commands(sys.stdin), proxy, args.concurrency, args.encoders, proxyPool)
+        sys.exit(1 if errors else 0)
+    if is_batch(os.path.abspath(args.input)):
+        with open(os.path.abspath(args.input)) as f:
+            errors = batch(load_commands(f), proxy, args.concurrency, args.encoders, proxyPool)
+        sys.exit(1 if errors else 0)
+    command = load_command(os.path.abspath(args.input))
+    if 'proxies' in command:
+        sys.exit(1 if snap_with_failover(command, proxyPool) else 0)
     try:
         timeout = command['timeout'] if 'timeout' in command else 60
         logging.info("Setting timeout at %ds" % timeout)
-        width, height, image, html, metadata = async_result.get(timeout=timeout)
-
-    except multiprocessing.TimeoutError:
-        logging.error("Timeout")
-        metadata['status'] = "error"
-        metadata['error'] = "Timeout"
-        metadata['time_finished'] = int(time())
+        metadata, error = snap_process(command)
     except:
         logging.error(sys.exc_info())
         traceback.print_exc()
-        metadata['error'] = str(sys.exc_info())
-    finally:
-        basename = os.path.splitext(command['file'])[0]
-        fpath = {'png': basename + ".png",
-                 'html': basename + ".html",
-                 'metadata': basename + ".finished"}
-        error = metadata['error'] != "0"
-        if error:
-            logging.error(metadata['error'])
-        if html:
-            if 'details' in command and command['details'] == 3:
-                url = metadata['final_url']
-                xhtml = lxml.html.document_fromstring(html)
-                metadata['images'] = get_elements(url, xhtml, 'img')
-                metadata['scripts'] = get_elements(url, xhtml, 'script')
-                metadata['stylesheets'] = get_elements(url, xhtml, 'link[@rel="stylesheet"]')
-                metadata['embeds'] = get_elements(url, xhtml, 'embed')
-                metadata['applets'] = get_elements(url, xhtml, 'applet')
-                metadata['iframes'] = get_elements(url, xhtml, 'iframe')
-            logging.info("Saving html: %s" % fpath['html'])
-            if 'html' in command and command['html'] == 1:
-                save_html(fpath['html'], html)
-        if metadata:
-            logging.info("Saving metadata: %s" % fpath['metadata'])
-            command.update(metadata)
-            save_json(fpath['metadata'], command)
-        if error:
-            sys.exit(1)
-        if image:
-           logging.info("Saving snapshot (%dx%d): %s" % (width, height, fpath['png']))
-           save_image(fpath['png'], image, width, height)
-        sys.exit(0)
+        error = save_results(command, None, None, None, None, {'error': str(sys.exc_info())})
+    sys.exit(1 if error else 0)
 
 if __name__ == "__main__":
     main()